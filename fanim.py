@@ -13,11 +13,16 @@ frame by frame animation.
 
 """
 from gimpfu import register, main, gimp, pdb, \
-        TRANSPARENT_FILL, RGBA_IMAGE, NORMAL_MODE
+        TRANSPARENT_FILL, RGBA_IMAGE, NORMAL_MODE, RGB, CLIP_TO_IMAGE, \
+        CHANNEL_OP_REPLACE, NO_DITHER, MAKE_PALETTE, \
+        PF_STRING, PF_OPTION, PF_DIRNAME
 
 import pygtk
 pygtk.require('2.0')
-import gtk, array, time, os, json
+import gtk, gobject, array, time, os, sys, json, zlib, heapq, struct, mmap, hashlib
+import glob, subprocess, argparse, multiprocessing, re, colorsys
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 
 # general info
 VERSION = 1.16
@@ -29,9 +34,17 @@ WEBSITE = "https://github.com/douglasvini/gimp-fanim"
 YEAR = "2016-2019"
 DESCRIPTION = "Timeline to edit frames and play animations with some aditional functionality."
 GIMP_LOCATION = "<Image>/FAnim/FAnim Timeline"
+BATCH_DESCRIPTION = "Export the gif, spritesheet or apng versions of many xcf files."
+BATCH_FORMATS = ["gif","spritesheet","apng"]
+BATCH_PROCEDURE = "python-fu-fanim-batch-export"
+STREAM_FORMATS = [("gif","Animated GIF",".gif"),("apng","Animated PNG",".png"),
+        ("sequence","PNG sequence",".png")]
+BATCH_CHUNK = 16 # files exported by each gimp instance of the command line batch.
 
 # fixed frames prefix in the end to store visibility fix for the playback understand.
 PREFIX="_fix"
+# gimp convention for the time a frame is showed, on the layer name.
+DURATION = re.compile(r"\s*\((\d+)\s*ms\)")
 
 # playback macros
 NEXT = 1
@@ -52,6 +65,24 @@ OSKIN_DEPTH = "oskin_depth"
 OSKIN_ONPLAY = "oskin_onplay"
 OSKIN_FORWARD = "oskin_forward"
 OSKIN_BACKWARD = "oskin_backward"
+OSKIN_FALLOFF = "oskin_falloff"
+OSKIN_TINT = "oskin_tint"
+OSKIN_BACKWARD_COLOR = "oskin_backward_color"
+OSKIN_FORWARD_COLOR = "oskin_forward_color"
+PLAY_PREVIEW = "play_preview"
+PROXY_SCALE = "proxy_scale"
+PREFETCH_FRAMES = "prefetch_frames"
+CACHE_SIZE = "cache_size"
+DROP_FRAMES = "drop_frames"
+THUMB_CACHE_SIZE = "thumb_cache_size"
+THUMB_STORE_SIZE = "thumb_store_size"
+EXPORT_CACHE_SIZE = "export_cache_size"
+SPARSE_FRAMES = "sparse_frames"
+SHEET_COLUMNS = "sheet_columns"
+SHEET_MAX_SIZE = "sheet_max_size"
+SHEET_TRIM = "sheet_trim"
+SHEET_FOLD = "sheet_fold"
+SEQUENCE_PATTERN = "sequence_pattern"
 
 # state to disable the buttons
 PLAYING = 1
@@ -60,11 +91,88 @@ NO_FRAMES = 2
 # onionskin constants
 OSKIN_MAX_DEPTH = 6
 OSKIN_MAX_OPACITY = 50.0
+OSKIN_DEFAULT_FALLOFF = 0.6 # opacity kept from a frame to the next farther one.
+OSKIN_DEFAULT_BACKWARD_COLOR = "#ff3030"
+OSKIN_DEFAULT_FORWARD_COLOR = "#3080ff"
+ONION_LAYER = "FAnim onion skin" # name of the overlay layer.
+FIXED_BELOW_LAYER = "FAnim fixed below" # names of the merged fixed frames layers.
+FIXED_ABOVE_LAYER = "FAnim fixed above"
+OVERLAY_LAYERS = (ONION_LAYER,FIXED_BELOW_LAYER,FIXED_ABOVE_LAYER)
+
+# frame cache constants, sizes in megabytes.
+CACHE_DEFAULT_SIZE = 256
+# share of the frames cache size of the preview frames, the onionskin overlays and
+# the merged fixed frames.
+CACHE_SHARES = (0.5,0.25,0.25)
+CACHE_MAX_SIZE = 4096
+THUMB_CACHE_DEFAULT_SIZE = 32
+THUMB_SIZE = 100
+THUMB_STORE_DEFAULT_SIZE = 64
+THUMB_STORE_DIR = "thumbs"
+EXPORT_CACHE_DEFAULT_SIZE = 128
+
+# preview playback resolutions, the fit scale follows the preview window size.
+PROXY_SCALES = [("full","Full",1.0),("half","1/2",0.5),("quarter","1/4",0.25),
+        ("fit","Fit window",None)]
+PROXY_DEFAULT_SCALE = "full"
+
+# frames prepared ahead of the playhead.
+PREFETCH_DEFAULT_FRAMES = 8
+PREFETCH_MAX_FRAMES = 64
+
+# spritesheet constants, columns 0 packs the frames up to the max size.
+SHEET_DEFAULT_MAX_SIZE = 4096
+SHEET_MAX_COLUMNS = 256
+SHEET_PADDING = 1
+
+# names of the png sequence files, fields {name} {frame} and {index}.
+SEQUENCE_DEFAULT_PATTERN = "{name}_{index:04d}.png"
 
 CONF_FILENAME = "conf.json"
 
 class Utils:
 
+    @staticmethod
+    def remove_layers_named(image,names):
+        """
+        Remove the image layers with one of the names out of the undo history, as
+        the overlays left on the image when it was saved with them.
+        """
+        stale = [l for l in image.layers if l.name in names]
+        if stale:
+            pdb.gimp_image_undo_freeze(image)
+            for l in stale:
+                image.remove_layer(l)
+            pdb.gimp_image_undo_thaw(image)
+
+    @staticmethod
+    def crop_to_content(layer):
+        """
+        Crop the transparent borders of a layer by the bounds of its alpha, the
+        offsets keep the content on its place, and return the bounds (x,y,w,h) on
+        the image. An empty layer is kept as a single pixel, a group can't be
+        resized and is kept as it is. The image selection is restored after.
+        """
+        ox, oy = layer.offsets
+        if pdb.gimp_item_is_group(layer):
+            return (ox,oy,layer.width,layer.height)
+        image = layer.image
+        saved = None
+        if not pdb.gimp_selection_is_empty(image):
+            saved = pdb.gimp_selection_save(image)
+        pdb.gimp_image_select_item(image,CHANNEL_OP_REPLACE,layer)
+        non_empty, x1, y1, x2, y2 = pdb.gimp_selection_bounds(image)
+        if saved != None:
+            pdb.gimp_image_select_item(image,CHANNEL_OP_REPLACE,saved)
+            image.remove_channel(saved)
+        else:
+            pdb.gimp_selection_none(image)
+
+        if not non_empty:
+            x1, y1, x2, y2 = ox, oy, ox + 1, oy + 1
+        pdb.gimp_layer_resize(layer,x2 - x1,y2 - y1,ox - x1,oy - y1)
+        return (x1,y1,x2 - x1,y2 - y1)
+
     @staticmethod
     def add_fixed_prefix(layer):
         """
@@ -91,6 +199,40 @@ class Utils:
         name = layer.name
         return name[-4:] == PREFIX
 
+    @staticmethod
+    def frame_duration(name,default=None):
+        """
+        Return the duration in ms written on a layer name as "(Nms)" or default.
+        """
+        match = DURATION.search(name)
+        if match == None:
+            return default
+        return max(1,int(match.group(1)))
+
+    @staticmethod
+    def with_duration(name,duration=None):
+        """
+        Return the layer name with the duration replaced, or removed when None,
+        keeping the fixed prefix at the end.
+        """
+        name = DURATION.sub("",name)
+        if duration == None:
+            return name
+        fixed = name[-4:] == PREFIX
+        if fixed:
+            name = name[:-4]
+        name += " (%dms)" %int(round(duration))
+        return name + PREFIX if fixed else name
+
+    @staticmethod
+    def clock():
+        """
+        Return the time in seconds from a monotonic clock when python provides one.
+        """
+        if hasattr(time,'monotonic'):
+            return time.monotonic()
+        return time.time()
+
     @staticmethod
     def button_stock(stock,size):
         """
@@ -127,39 +269,1863 @@ class Utils:
         h.pack_start(b)
         return h,adjustment
 
-    @staticmethod
-    def load_conffile(filename):
+    @staticmethod
+    def user_directory(*names):
+        """
+        Return a folder inside the fanim folder of the gimp user folder, creating
+        it when needed.
+        """
+        directory = os.path.join(gimp.directory,"fanim",*names)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return directory
+
+    @staticmethod
+    def load_conffile(filename):
+        """
+        Load configuration from a file stored in gimp user folder.
+        """
+        directory = gimp.directory + "/fanim"
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+        filepath = directory + "/" + filename
+        if os.path.exists(filepath):
+            f = open(filepath,'r')
+            dic = json.load(f)
+            f.close()
+            return dic
+
+        else:
+            return None
+
+    @staticmethod
+    def save_conffile(filename,conf={}):
+        """
+        Save a configuration dictionary in a json file on user folder.
+        """
+        directory = gimp.directory + "/fanim"
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+        filepath = directory + "/" + filename
+        f = open(filepath,'w')
+        json.dump(conf,f)
+        f.close()
+
+class LayerState(object):
+    """
+    Local copy of the layer properties used by the timeline, each property is read
+    from gimp once and the changes are kept until flush is called, so reading or
+    writing them don't need a round-trip to gimp every time.
+    """
+    PROPERTIES = ('name','visible','opacity','mode')
+
+    def __init__(self,layer,dirty=None):
+        self.layer = layer
+        self.ID = layer.ID
+        self._dirty = dirty # set shared with the timeline to know what to flush.
+        self._values = {}
+        self._pending = {}
+        self.sync()
+
+    def sync(self):
+        """
+        Read the properties from gimp again, discarding the not flushed changes,
+        return if any of them was changed outside the timeline.
+        """
+        changed = False
+        for p in self.PROPERTIES:
+            value = getattr(self.layer,p)
+            changed = changed or self._values.get(p,value) != value
+            self._values[p] = value
+        self._pending = {}
+        return changed
+
+    def flush(self):
+        """
+        Write the changed properties to gimp.
+        """
+        for p, value in self._pending.items():
+            setattr(self.layer,p,value)
+        self._pending = {}
+
+    def _get(self,p):
+        return self._values[p]
+
+    def _set(self,p,value):
+        if self._values[p] == value:
+            return
+        self._values[p] = value
+        self._pending[p] = value
+        if self._dirty != None:
+            self._dirty.add(self)
+
+    name = property(lambda self: self._get('name'),
+            lambda self,v: self._set('name',v))
+    visible = property(lambda self: self._get('visible'),
+            lambda self,v: self._set('visible',v))
+    opacity = property(lambda self: self._get('opacity'),
+            lambda self,v: self._set('opacity',v))
+    mode = property(lambda self: self._get('mode'),
+            lambda self,v: self._set('mode',v))
+
+    @property
+    def fixed(self):
+        return Utils.is_frame_fixed(self)
+
+
+class LRUCache:
+    """
+    Store values up to a memory budget in bytes, when the budget is exceeded the
+    least recently used values are discarded first.
+    """
+    def __init__(self,budget,on_discard=None):
+        self.budget = budget
+        self.used = 0
+        self.on_discard = on_discard # called with each value leaving the cache.
+        self._items = OrderedDict() # key: (value, size, deps)
+
+    def __contains__(self,key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self,key):
+        """
+        Return the value stored on key or None, marking it as the most recently used.
+        """
+        if key not in self._items:
+            return None
+        item = self._items.pop(key)
+        self._items[key] = item
+        return item[0]
+
+    def put(self,key,value,size,deps=()):
+        """
+        Store a value, deps is a list of identifiers used later to invalidate it.
+        A value bigger than the whole budget is discarded right away, return if
+        it was stored.
+        """
+        self.discard(key)
+        if size > self.budget:
+            if self.on_discard != None:
+                self.on_discard(value)
+            return False
+        self._items[key] = (value,size,tuple(deps))
+        self.used += size
+        self._evict()
+        return True
+
+    def discard(self,key):
+        if key in self._items:
+            item = self._items.pop(key)
+            self.used -= item[1]
+            if self.on_discard != None:
+                self.on_discard(item[0])
+
+    def invalidate(self,dep):
+        """
+        Discard every value that depends on dep.
+        """
+        for key in [k for k,v in self._items.items() if dep in v[2]]:
+            self.discard(key)
+
+    def clear(self):
+        if self.on_discard != None:
+            for item in self._items.values():
+                self.on_discard(item[0])
+        self._items.clear()
+        self.used = 0
+
+    def has_room(self):
+        """
+        Return if one more value of the average size fits without discarding any.
+        """
+        return not self._items or self.used + self.used / len(self._items) <= self.budget
+
+    def items(self):
+        """
+        Return the (key, value) pairs from the least to the most recently used.
+        """
+        return [(k,v[0]) for k,v in self._items.items()]
+
+    def set_budget(self,budget):
+        self.budget = budget
+        self._evict()
+
+    def _evict(self):
+        while self.used > self.budget and self._items:
+            key, item = self._items.popitem(False)
+            self.used -= item[1]
+            if self.on_discard != None:
+                self.on_discard(item[0])
+
+
+class Scratch:
+    """
+    Hidden image without undo history where the layers of an image are copied
+    and merged, it's created again when the canvas size changes.
+    """
+    def __init__(self,base_type=RGB,on_reset=None):
+        self.base_type = base_type
+        self.on_reset = on_reset # called before the layers kept on the image are lost.
+        self.image = None
+
+    def get(self,width,height):
+        if self.image == None or self.image.width != width or self.image.height != height:
+            if self.image != None:
+                if self.on_reset != None:
+                    self.on_reset()
+                pdb.gimp_image_delete(self.image)
+            self.image = gimp.Image(width,height,self.base_type)
+            self.image.disable_undo()
+        return self.image
+
+    def merge(self,image,layers,opaque=False):
+        """
+        Return a hidden layer with the layers of image merged from bottom to top,
+        with the size of the canvas. Opaque copies the layers with full opacity
+        and normal mode. The layers are merged down one on the other, so the other
+        layers kept on the scratch image don't take part.
+        """
+        scratch = self.get(image.width,image.height)
+        merged = None
+        for layer in layers:
+            copy = pdb.gimp_layer_new_from_drawable(layer,scratch)
+            scratch.add_layer(copy,0)
+            copy.visible = True
+            if opaque:
+                copy.opacity = 100.0
+                copy.mode = NORMAL_MODE
+            if merged != None:
+                copy = pdb.gimp_image_merge_down(scratch,copy,CLIP_TO_IMAGE)
+            merged = copy
+        pdb.gimp_layer_resize_to_image_size(merged)
+        merged.visible = False
+        return merged
+
+    def remove(self,layer):
+        if self.image != None and pdb.gimp_item_is_valid(layer):
+            self.image.remove_layer(layer)
+
+    def destroy(self):
+        if self.image != None:
+            pdb.gimp_image_delete(self.image)
+            self.image = None
+
+
+class FrameCache:
+    """
+    Keep composited versions of the frames (the frame layer plus the visibly fixed
+    frames below and above it) as gtk pixbufs, so the playback don't need to touch
+    the layers visibility on each frame. The fixed frames come already merged from
+    the timeline FixedStack.
+    """
+    def __init__(self,timeline,budget=CACHE_DEFAULT_SIZE,slice_time=0.02):
+        self.timeline = timeline
+        self.cache = LRUCache(int(budget * 1024 * 1024))
+        self.slice_time = slice_time # seconds of background work on each idle call.
+        self._scratch = Scratch() # hidden image used to composite the frames.
+        self._build_size = None # size of the frames built in the background.
+        self._build_next = 0
+        self._source = None
+
+    def set_budget(self,budget):
+        self.cache.set_budget(int(budget * 1024 * 1024))
+
+    def stack(self,index):
+        """
+        Return the layers that compose the frame on index from bottom to top.
+        """
+        below, above = self.timeline.fixed_stack.stacks(index)
+        return below + [self.timeline.frames[index].layer] + above
+
+    def get(self,index,size=None):
+        """
+        Return the pixbuf of the frame on index, compositing it if needed, scaled
+        down to a (width, height) proxy size or with the canvas size when None.
+        """
+        layers = self.stack(index)
+        ids = tuple(l.ID for l in layers)
+        key = (ids,size)
+        pixbuf = self.cache.get(key)
+        if pixbuf == None:
+            fixed = self.timeline.fixed_stack
+            below, above = fixed.stacks(index)
+            layers = [l for l in (fixed.merged(below),self.timeline.frames[index].layer,
+                    fixed.merged(above)) if l != None]
+            pixbuf = self._composite(layers,size)
+            self.cache.put(key,pixbuf,pixbuf.get_rowstride() * pixbuf.get_height(),ids)
+        return pixbuf
+
+    def has(self,index,size=None):
+        return (tuple(l.ID for l in self.stack(index)),size) in self.cache
+
+    def build(self,size):
+        """
+        Composite the frames with the proxy size in the background of the gtk main
+        loop, in small time slices, until every normal frame is cached or the
+        budget is full. The frames invalidated later are built again.
+        """
+        self._build_size = size
+        self._build_next = 0
+        if self._source == None:
+            self._source = gobject.idle_add(self._process)
+
+    def stop_build(self):
+        self._build_size = None
+        if self._source != None:
+            gobject.source_remove(self._source)
+            self._source = None
+
+    def _process(self):
+        start = Utils.clock()
+        frames = self.timeline.frames
+        while self._build_next < len(frames) and Utils.clock() - start < self.slice_time:
+            index = self._build_next
+            self._build_next += 1
+            if frames[index].fixed or self.has(index,self._build_size):
+                continue
+            # a frame bigger than the space left would discard the frames built.
+            if not self.cache.has_room():
+                self._build_next = len(frames)
+                break
+            self.get(index,self._build_size)
+
+        if self._build_next >= len(frames):
+            self._source = None
+            return False
+        return True
+
+    def invalidate(self,layer=None):
+        """
+        Discard the frames that use the layer, or everything when layer is None.
+        """
+        if layer == None:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(layer.ID)
+        if self._build_size != None:
+            self.build(self._build_size)
+
+    def destroy(self):
+        self.stop_build()
+        self.cache.clear()
+        self._scratch.destroy()
+
+    def _composite(self,layers,size=None):
+        image = self.timeline.image
+        width, height = image.width, image.height
+
+        # copy the layers to the scratch image and merge them together.
+        merged = self._scratch.merge(image,layers,True)
+        if not merged.has_alpha:
+            merged.add_alpha()
+        # the proxies are scaled by gimp, so only their pixels are read.
+        if size != None and size != (width,height):
+            width, height = size
+            pdb.gimp_layer_scale(merged,width,height,False)
+
+        rgn = merged.get_pixel_rgn(0,0,width,height,False,False)
+        data = rgn[0:width,0:height]
+        c = merged.bpp
+        self._scratch.remove(merged)
+
+        return gtk.gdk.pixbuf_new_from_data(data,gtk.gdk.COLORSPACE_RGB,c>3,8,
+                width,height,width*c)
+
+
+class ThumbnailCache:
+    """
+    Keep the frames thumbnails by layer ID together with a signature of the
+    thumbnail content, so the rescans can reuse them and a refreshed layer
+    whose pixels are the same keeps the old pixbuf. When a ThumbnailStore is
+    open the missing thumbnails are read from it before asking gimp.
+    """
+    def __init__(self,budget=THUMB_CACHE_DEFAULT_SIZE,size=THUMB_SIZE):
+        self.size = size
+        self.cache = LRUCache(budget * 1024 * 1024)
+        self.store = None
+        self._tattoos = {} # layer tattoo by layer ID, read when a store is used.
+
+    def set_budget(self,budget):
+        self.cache.set_budget(int(budget * 1024 * 1024))
+
+    def open_store(self,store,load=True):
+        """
+        Use the thumbnails saved on store, when it's valid for the document. When
+        load is False the saved thumbnails aren't read, the store is only written.
+        """
+        self.store = store
+        if load:
+            store.load()
+
+    def save_store(self,stamp):
+        """
+        Save the cached thumbnails on the store for the document file stamp.
+        """
+        if self.store == None:
+            return
+        thumbs = {}
+        for layer_id, (signature,pixbuf) in self.cache.items():
+            tattoo = self._tattoos.get(layer_id)
+            w, h, c = signature[:3]
+            data = pixbuf.get_pixels()
+            if tattoo != None and len(data) == w * h * c:
+                thumbs[tattoo] = (w,h,c,data)
+        self.store.save(stamp,thumbs)
+
+    def close_store(self):
+        if self.store != None:
+            self.store.close()
+            self.store = None
+
+    def get(self,layer,refresh=False):
+        """
+        Return the thumbnail pixbuf of the layer, when refresh is True the
+        thumbnail is fetched from gimp again and compared with the cached one.
+        """
+        entry = self.cache.get(layer.ID)
+        if entry != None and not refresh:
+            return entry[1]
+
+        stored = None
+        if self.store != None:
+            tattoo = self._tattoos.get(layer.ID)
+            if tattoo == None:
+                tattoo = self._tattoos[layer.ID] = pdb.gimp_item_get_tattoo(layer)
+            if not refresh:
+                stored = self.store.get(tattoo)
+
+        if stored != None:
+            w,h,c,data = stored
+        else:
+            image_data = pdb.gimp_drawable_thumbnail(layer,self.size,self.size)
+            w,h,c,data = image_data[0],image_data[1],image_data[2],image_data[4]
+
+        # the pixel data is used directly when gimp returns it as a buffer, when it
+        # comes as a sequence of values it's packed once as unsigned 8bit data.
+        if not isinstance(data,(str,bytes,array.array)):
+            data = array.array('B',data)
+
+        # the same size and pixels than the cached thumbnail, nothing changed.
+        signature = (w,h,c,zlib.crc32(data))
+        if entry != None and entry[0] == signature:
+            return entry[1]
+
+        pixbuf = gtk.gdk.pixbuf_new_from_data(data,gtk.gdk.COLORSPACE_RGB,c>3,8,w,h,w*c)
+        self.cache.put(layer.ID,(signature,pixbuf),w*h*c,(layer.ID,))
+        return pixbuf
+
+    def signature(self,layer):
+        """
+        Return the signature of the cached thumbnail of the layer or None.
+        """
+        entry = self.cache.get(layer.ID)
+        if entry == None:
+            return None
+        return entry[0]
+
+    def lookup(self,layer):
+        """
+        Return the cached thumbnail of the layer or None, without asking gimp.
+        """
+        entry = self.cache.get(layer.ID)
+        if entry == None:
+            return None
+        return entry[1]
+
+    def discard(self,layer):
+        self.cache.discard(layer.ID)
+
+
+class ThumbnailLoader:
+    """
+    Load the frames thumbnails in the background of the gtk main loop. The
+    requests are served by priority in small time slices, so the UI keeps
+    responding while a long timeline is loaded, and each thumbnail is sent to
+    the frame widget when it's ready. on_changed is called with the frame
+    when a refreshed thumbnail differs from the cached one.
+    """
+    def __init__(self,thumbnails,slice_time=0.01,on_changed=None):
+        self.thumbnails = thumbnails
+        self.slice_time = slice_time # seconds of work on each idle call.
+        self.on_changed = on_changed
+        self.placeholder = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB,True,8,
+                thumbnails.size,thumbnails.size)
+        self.placeholder.fill(0x80808040)
+
+        self._queue = [] # heap of (priority, order, frame, refresh)
+        self._pending = {} # queued (priority, refresh) by layer ID.
+        self._order = 0
+        self._source = None
+
+    def request(self,frame,priority,refresh=False):
+        """
+        Queue the thumbnail of the frame, lower priorities are loaded first.
+        """
+        queued = self._pending.get(frame.layer.ID)
+        if queued != None:
+            refresh = refresh or queued[1]
+            if queued[0] <= priority and queued[1] == refresh:
+                return
+            priority = min(priority,queued[0])
+        self._pending[frame.layer.ID] = (priority,refresh)
+        self._order += 1
+        heapq.heappush(self._queue,(priority,self._order,frame,refresh))
+        if self._source == None:
+            self._source = gobject.idle_add(self._process)
+
+    def clear(self):
+        self._queue = []
+        self._pending = {}
+        if self._source != None:
+            gobject.source_remove(self._source)
+            self._source = None
+
+    def _process(self):
+        start = Utils.clock()
+        while self._queue and Utils.clock() - start < self.slice_time:
+            priority, order, frame, refresh = heapq.heappop(self._queue)
+            if self._pending.get(frame.layer.ID) != (priority,refresh):
+                continue # replaced by a request with a better priority.
+            del self._pending[frame.layer.ID]
+
+            # frames scrolled out of view are loaded again when showed, the
+            # refreshed ones are still compared with their cached thumbnail.
+            if frame.widget == None and not refresh:
+                continue
+            if not pdb.gimp_item_is_valid(frame.layer):
+                continue # removed on gimp before its turn.
+            signature = self.thumbnails.signature(frame.layer) if refresh else None
+            pixbuf = self.thumbnails.get(frame.layer,refresh)
+            if signature != None and self.on_changed != None and \
+                    self.thumbnails.signature(frame.layer) != signature:
+                self.on_changed(frame)
+            if frame.widget != None:
+                frame.widget.set_thumbnail(pixbuf)
+
+        if not self._queue:
+            self._source = None
+            return False
+        return True
+
+
+class ThumbnailStore:
+    """
+    Thumbnails of a document saved in a single binary file inside the fanim user
+    folder, so reopening the timeline shows them without asking gimp. The file
+    has a header with the document file stamp, an index of fixed size entries by
+    layer tattoo and the pixel data. It's memory mapped when loaded and each
+    thumbnail is checked against its checksum when read.
+    """
+    MAGIC = b"FATS"
+    VERSION = 1
+    # magic, version, thumbnail size, document mtime, document size, entries.
+    HEADER = struct.Struct("<4sHHdQI")
+    # tattoo, width, height, channels, data offset, data length, crc32.
+    ENTRY = struct.Struct("<IHHB3xIII")
+
+    def __init__(self,filename,size=THUMB_SIZE,budget=THUMB_STORE_DEFAULT_SIZE):
+        self.filename = filename # the document file.
+        self.size = size
+        self.budget = budget * 1024 * 1024 # size of all the store files.
+
+        self.directory = Utils.user_directory(THUMB_STORE_DIR)
+        path = os.path.abspath(filename)
+        if not isinstance(path,bytes):
+            path = path.encode('utf-8')
+        name = hashlib.sha1(path).hexdigest()
+        self.path = os.path.join(self.directory,name + ".bin")
+
+        self.stamp = None # document stamp of the stored thumbnails.
+        self.index = {} # (width, height, channels, offset, length, crc) by tattoo.
+        self._file = None
+        self._map = None
+
+    @staticmethod
+    def file_stamp(filename):
+        """
+        Return the (mtime, size) of the document file or None.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime,st.st_size)
+
+    def load(self):
+        """
+        Map the store file, it's only used when it matches the document file as
+        it is now on disk.
+        """
+        self.close()
+        stamp = ThumbnailStore.file_stamp(self.filename)
+        if stamp == None or not os.path.exists(self.path):
+            return False
+
+        try:
+            self._file = open(self.path,'rb')
+            self._map = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        except (IOError,OSError,ValueError):
+            self.close()
+            return False
+
+        length = len(self._map)
+        if length < self.HEADER.size:
+            self.close()
+            return False
+        magic, version, size, mtime, fsize, count = self.HEADER.unpack_from(self._map,0)
+        if magic != self.MAGIC or version != self.VERSION or size != self.size \
+                or (mtime,fsize) != stamp \
+                or self.HEADER.size + count * self.ENTRY.size > length:
+            self.close()
+            return False
+
+        for i in range(count):
+            entry = self.ENTRY.unpack_from(self._map,self.HEADER.size + i * self.ENTRY.size)
+            tattoo, w, h, c, offset, data_length, crc = entry
+            if offset + data_length <= length and w * h * c == data_length:
+                self.index[tattoo] = (w,h,c,offset,data_length,crc)
+        self.stamp = stamp
+
+        # mark the store as recently used for the eviction.
+        os.utime(self.path,None)
+        return True
+
+    def get(self,tattoo):
+        """
+        Return the stored (width, height, channels, data) of the layer tattoo or
+        None, discarding the thumbnails that don't match their checksum.
+        """
+        entry = self.index.get(tattoo)
+        if entry == None or self._map == None:
+            return None
+        w, h, c, offset, length, crc = entry
+        data = self._map[offset:offset + length]
+        if zlib.crc32(data) & 0xffffffff != crc:
+            del self.index[tattoo]
+            return None
+        return (w,h,c,data)
+
+    def save(self,stamp,thumbs):
+        """
+        Write the thumbnails (width, height, channels, data) by tattoo for the
+        document stamp, keeping the stored ones that are still valid, and evict
+        the least recently used stores above the size budget.
+        """
+        if stamp == None:
+            return
+        entries = {}
+        if stamp == self.stamp:
+            for tattoo in self.index.keys():
+                if tattoo not in thumbs:
+                    stored = self.get(tattoo)
+                    if stored != None:
+                        entries[tattoo] = stored
+        entries.update(thumbs)
+        self.close()
+
+        tattoos = sorted(entries.keys())
+        offset = self.HEADER.size + len(tattoos) * self.ENTRY.size
+        header = [self.HEADER.pack(self.MAGIC,self.VERSION,self.size,stamp[0],stamp[1],
+                len(tattoos))]
+        blobs = []
+        for tattoo in tattoos:
+            w, h, c, data = entries[tattoo]
+            crc = zlib.crc32(data) & 0xffffffff
+            header.append(self.ENTRY.pack(tattoo,w,h,c,offset,len(data),crc))
+            blobs.append(data)
+            offset += len(data)
+
+        tmp = self.path + ".tmp"
+        f = open(tmp,'wb')
+        f.write(b"".join(header))
+        for data in blobs:
+            f.write(data)
+        f.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp,self.path)
+
+        ThumbnailStore.evict(self.directory,self.budget)
+
+    def close(self):
+        if self._map != None:
+            self._map.close()
+            self._map = None
+        if self._file != None:
+            self._file.close()
+            self._file = None
+        self.index = {}
+        self.stamp = None
+
+    @staticmethod
+    def evict(directory,budget):
+        """
+        Remove the least recently used store files until they fit on budget bytes.
+        """
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory,name)
+            if name.endswith(".bin"):
+                st = os.stat(path)
+                files.append((st.st_mtime,st.st_size,path))
+        files.sort()
+        total = sum(f[1] for f in files)
+        for mtime, size, path in files:
+            if total <= budget:
+                break
+            os.remove(path)
+            total -= size
+
+
+class PNGEncoder:
+    """
+    Minimal png encoder of 8 bits RGBA pixels, enough to stream the frames
+    without building a gimp image to save them.
+    """
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    @staticmethod
+    def chunk(kind,data):
+        crc = zlib.crc32(kind + data) & 0xffffffff
+        return struct.pack(">I",len(data)) + kind + data + struct.pack(">I",crc)
+
+    @staticmethod
+    def header(width,height):
+        return PNGEncoder.chunk(b"IHDR",struct.pack(">IIBBBBB",width,height,8,6,0,0,0))
+
+    @staticmethod
+    def compress(width,height,pixels,level=6):
+        """
+        Return the zlib stream of the rows, each one without filter.
+        """
+        stride = width * 4
+        rows = b"".join(b"\0" + pixels[y * stride:(y + 1) * stride] for y in range(height))
+        return zlib.compress(rows,level)
+
+    @staticmethod
+    def encode(width,height,pixels,level=6):
+        return (PNGEncoder.SIGNATURE + PNGEncoder.header(width,height)
+                + PNGEncoder.chunk(b"IDAT",PNGEncoder.compress(width,height,pixels,level))
+                + PNGEncoder.chunk(b"IEND",b""))
+
+
+class AnimationWriter:
+    """
+    Receive the composited frames one by one and encode them, the writers with
+    indexed receive (index,alpha) pixels and the palette, the others RGBA pixels.
+    It's not used by itself, each format gives its encode and write_data.
+    """
+    indexed = False
+    kind = None # name of the encoded frames on the export cache.
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.width = self.height = 0
+
+    @staticmethod
+    def create(format,filename,**options):
+        writers = {'gif':GIFWriter,'apng':APNGWriter,'sequence':PNGSequenceWriter}
+        return writers[format](filename,**options)
+
+    def begin(self,width,height,count):
+        self.width, self.height = width, height
+        self._file = open(self.filename,'wb')
+
+    def encode(self,pixels,palette=None):
+        """
+        Return the frame encoded for the format, what the export cache keeps.
+        """
+
+    def write_data(self,data,delay):
+        """
+        Write a frame returned by encode, with its delay in milliseconds.
+        """
+
+    def write(self,pixels,delay,palette=None,name=""):
+        """
+        Encode and write a frame, return the encoded frame.
+        """
+        data = self.encode(pixels,palette)
+        self.write_data(data,delay)
+        return data
+
+    def reuse(self,cache,signature,delay,name=""):
+        """
+        Write the frame encoded on a past export if there is one, return if it
+        was written.
+        """
+        data = cache.get(self.kind,signature)
+        if data == None:
+            return False
+        self.write_data(data,delay)
+        return True
+
+    def store(self,cache,signature,data):
+        cache.put(self.kind,signature,data,len(data))
+
+    def finish(self):
+        self._file.close()
+
+    def abort(self):
+        """
+        Stop writing and remove the partial output.
+        """
+        self._file.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def png_write_file(args):
+    """
+    Encode and save a png file, runs on the sequence writer worker processes.
+    """
+    filename, width, height, pixels = args
+    with open(filename,'wb') as f:
+        f.write(PNGEncoder.encode(width,height,pixels))
+
+
+class PNGSequenceWriter(AnimationWriter):
+    """
+    Write each frame as a png file named by the pattern, with the fields {name}
+    of the chosen file, {frame} the layer name and {index} the frame number.
+    The png compression runs on a pool of processes, one for each cpu.
+    """
+    kind = 'sequence'
+
+    def __init__(self,filename,pattern=SEQUENCE_DEFAULT_PATTERN,processes=0):
+        AnimationWriter.__init__(self,filename)
+        self.directory = os.path.dirname(filename)
+        self.name = os.path.splitext(os.path.basename(filename))[0]
+        self.pattern = pattern
+        self.processes = processes or multiprocessing.cpu_count()
+        self.index = 0 # number of the last frame.
+        self.written = []
+        self._pool = None
+        self._pending = deque()
+
+    def begin(self,width,height,count):
+        self.width, self.height = width, height
+        self.index = 0
+        self.written = []
+        # the workers are forked, they only encode and never talk to gimp.
+        if self.processes > 1 and count > 1 and hasattr(os,"fork"):
+            self._pool = multiprocessing.Pool(self.processes)
+
+    def filename_of(self,index,frame=""):
+        frame = re.sub(r'[\\/:*?"<>|]',"_",frame)
+        return os.path.join(self.directory,self.pattern.format(name=self.name,
+            frame=frame,index=index))
+
+    def write(self,pixels,delay,palette=None,name=""):
+        """
+        Write a frame and return its file name.
+        """
+        self.index += 1
+        filename = self.filename_of(self.index,name)
+        self.written.append(filename)
+        args = (filename,self.width,self.height,pixels)
+        if self._pool == None:
+            png_write_file(args)
+            return filename
+        self._pending.append(self._pool.apply_async(png_write_file,(args,)))
+        # keep a few frames waiting for the workers, so the memory stays bounded.
+        while len(self._pending) > 2 * self.processes:
+            self._pending.popleft().get()
+        return filename
+
+    def reuse(self,cache,signature,delay,name=""):
+        """
+        Skip the frame when its file was written with the same signature.
+        """
+        filename = self.filename_of(self.index + 1,name)
+        if cache.files.get(filename) != signature or not os.path.exists(filename):
+            return False
+        self.index += 1
+        return True
+
+    def store(self,cache,signature,filename):
+        cache.files[filename] = signature
+
+    def finish(self):
+        while self._pending:
+            self._pending.popleft().get()
+        if self._pool != None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def abort(self):
+        self._pending.clear()
+        if self._pool != None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for filename in self.written:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.written = []
+
+
+class APNGWriter(AnimationWriter):
+    """
+    Write an animated png, looping forever.
+    """
+    kind = 'apng'
+
+    def begin(self,width,height,count):
+        AnimationWriter.begin(self,width,height,count)
+        self._sequence = 0
+        self._file.write(PNGEncoder.SIGNATURE + PNGEncoder.header(width,height))
+        self._file.write(PNGEncoder.chunk(b"acTL",struct.pack(">II",count,0)))
+
+    def encode(self,pixels,palette=None):
+        return PNGEncoder.compress(self.width,self.height,pixels)
+
+    @staticmethod
+    def delay_fraction(delay):
+        """
+        Return the delay in milliseconds as the 16 bit numerator and denominator
+        of seconds, the long holds are written with a coarser denominator.
+        """
+        numerator, denominator = int(round(delay)), 1000
+        while numerator > 0xffff and denominator > 1:
+            numerator, denominator = int(round(numerator / 10.0)), denominator // 10
+        return min(numerator,0xffff), denominator
+
+    def write_data(self,data,delay):
+        numerator, denominator = self.delay_fraction(delay)
+        control = struct.pack(">IIIIIHHBB",self._sequence,self.width,self.height,
+                0,0,numerator,denominator,0,0)
+        self._file.write(PNGEncoder.chunk(b"fcTL",control))
+        if self._sequence == 0:
+            # the first frame is also the default image.
+            self._file.write(PNGEncoder.chunk(b"IDAT",data))
+            self._sequence = 1
+        else:
+            self._file.write(PNGEncoder.chunk(b"fdAT",struct.pack(">I",self._sequence + 1) + data))
+            self._sequence += 2
+
+    def finish(self):
+        self._file.write(PNGEncoder.chunk(b"IEND",b""))
+        AnimationWriter.finish(self)
+
+
+class GIFWriter(AnimationWriter):
+    """
+    Write an animated gif looping forever, each frame with its own palette of
+    255 colors, the last index is the transparent color.
+    """
+    indexed = True
+    kind = 'gif'
+    TRANSPARENT = 255
+
+    def begin(self,width,height,count):
+        AnimationWriter.begin(self,width,height,count)
+        self._file.write(b"GIF89a" + struct.pack("<HHBBB",width,height,0,0,0))
+        # netscape extension to loop the animation.
+        self._file.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H",0) + b"\x00")
+
+    def encode(self,pixels,palette=None):
+        """
+        Return the local color table and the lzw blocks of the frame.
+        """
+        indices = bytearray(pixels[0::2])
+        alpha = bytearray(pixels[1::2])
+        for i in [i for i, a in enumerate(alpha) if a < 128]:
+            indices[i] = self.TRANSPARENT
+        data = bytearray(palette[:765])
+        data.extend(bytearray(768 - len(data)))
+
+        data.append(8)
+        codes = self.lzw(indices)
+        for i in range(0,len(codes),255):
+            block = codes[i:i + 255]
+            data.append(len(block))
+            data.extend(block)
+        data.append(0)
+        return bytes(data)
+
+    def write_data(self,data,delay):
+        # graphic control, restore to background and transparent index, the delay
+        # in hundredths of second is limited to 16 bits.
+        self._file.write(b"\x21\xf9\x04" + struct.pack("<BHBB",0x09,
+                min(int(round(delay / 10.0)),0xffff),self.TRANSPARENT,0))
+        # image descriptor with a local color table of 256 colors.
+        self._file.write(b"\x2c" + struct.pack("<HHHHB",0,0,self.width,self.height,0x87))
+        self._file.write(data)
+
+    def finish(self):
+        self._file.write(b"\x3b")
+        AnimationWriter.finish(self)
+
+    @staticmethod
+    def lzw(indices,min_size=8):
+        """
+        Return the variable length lzw codes of the indices, as gif expects them.
+        """
+        clear = 1 << min_size
+        end = clear + 1
+        out = bytearray()
+        acc = bits = 0
+        size = min_size + 1
+        table = {}
+        next_code = end + 1
+
+        acc |= clear << bits
+        bits += size
+        prefix = indices[0]
+        for c in indices[1:]:
+            key = (prefix << 8) | c
+            code = table.get(key)
+            if code != None:
+                prefix = code
+                continue
+            acc |= prefix << bits
+            bits += size
+            while bits >= 8:
+                out.append(acc & 0xff)
+                acc >>= 8
+                bits -= 8
+            if next_code < 4096:
+                if next_code == 1 << size:
+                    size += 1
+                table[key] = next_code
+                next_code += 1
+            else:
+                # table full, start it again.
+                acc |= clear << bits
+                bits += size
+                table = {}
+                size = min_size + 1
+                next_code = end + 1
+            prefix = c
+
+        for code in (prefix,end):
+            acc |= code << bits
+            bits += size
+            if code == prefix and next_code == 1 << size and size < 12:
+                size += 1
+        while bits > 0:
+            out.append(acc & 0xff)
+            acc >>= 8
+            bits -= 8
+        return out
+
+
+class ExportCache:
+    """
+    Outputs of the past exports by frame signature, the hash of the frame layer
+    pixels and of the fixed layers applied to it. An export only composites the
+    frames whose signature changed, the others are patched in from here.
+    """
+    def __init__(self,budget=EXPORT_CACHE_DEFAULT_SIZE):
+        self.outputs = LRUCache(budget * 1024 * 1024)
+        self.files = {} # signature of the written sequence files by file name.
+
+    def set_budget(self,budget):
+        self.outputs.set_budget(budget * 1024 * 1024)
+
+    @staticmethod
+    def layer_digest(layer):
+        w, h = layer.width, layer.height
+        digest = hashlib.sha1(layer.get_pixel_rgn(0,0,w,h,False,False)[0:w,0:h])
+        digest.update(repr((layer.offsets,w,h,layer.mode,layer.opacity,layer.bpp)).encode())
+        return digest.hexdigest()
+
+    def signatures(self,plan,width,height,base_type):
+        """
+        Return the signature of each (frame, background, foreground) of the plan
+        on a canvas of width x height and base_type, the fixed layers are read once.
+        """
+        digests = {}
+        def digest(f):
+            if f.layer.ID not in digests:
+                digests[f.layer.ID] = self.layer_digest(f.layer)
+            return digests[f.layer.ID]
+
+        signatures = []
+        for frame, below, above in plan:
+            key = "%dx%d:%s|%s|%s|%s" %(width,height,base_type,digest(frame),
+                    ",".join(digest(f) for f in below),",".join(digest(f) for f in above))
+            signatures.append(hashlib.sha1(key.encode()).hexdigest())
+        return signatures
+
+    def get(self,kind,signature):
+        return self.outputs.get((kind,signature))
+
+    def put(self,kind,signature,value,size):
+        self.outputs.put((kind,signature),value,size)
+
+    def clear(self):
+        self.outputs.clear()
+        self.files = {}
+
+
+class Exporter:
+    """
+    Build the formated versions of the animation. For each normal frame the fixed
+    frames before it are its background and the ones after it its foreground,
+    the stacks are worked out in one pass and each distinct stack is merged once
+    and shared by all the frames that use it.
+    """
+    def __init__(self,image,frames,base_type=None,cache=None):
+        self.image = image
+        self.frames = frames
+        self.base_type = image.base_type if base_type == None else base_type
+        self.cache = cache # ExportCache of the frames exported before.
+        self._scratch = Scratch(self.base_type) # hidden image where the frames are merged.
+        self._merged = {} # merged layer by tuple of fixed layers IDs.
+
+    @classmethod
+    def from_image(cls,image,base_type=None):
+        """
+        Return an exporter of the image layers without a timeline, from the bottom
+        layer as the timeline does, the fixed frames are the layers with the fixed
+        prefix.
+        """
+        layers = [l for l in reversed(image.layers) if l.name not in OVERLAY_LAYERS]
+        return cls(image,[AnimFrame(LayerState(l)) for l in layers],base_type)
+
+    def duration(self,frame,default):
+        """
+        Return the "(Nms)" hold of a frame or default.
+        """
+        return default if frame.duration == None else frame.duration
+
+    def plan(self):
+        """
+        Return a list of (frame, background, foreground) of the normal frames, the
+        fixed frames on background and foreground are in the timeline order.
+        """
+        fixed = [f for f in self.frames if f.fixed]
+        plan = []
+        below = ()
+        for f in self.frames:
+            if f.fixed:
+                below = below + (f,)
+            else:
+                plan.append((f,below,tuple(fixed[len(below):])))
+        return plan
+
+    def merged(self,stack):
+        """
+        Return a layer with the fixed frames of stack merged, from bottom to top,
+        merging each distinct stack only once.
+        """
+        if not stack:
+            return None
+        key = tuple(f.layer.ID for f in stack)
+        if key not in self._merged:
+            self._merged[key] = self._scratch.merge(self.image,[f.layer for f in stack])
+        return self._merged[key]
+
+    def _scratch_image(self):
+        return self._scratch.get(self.image.width,self.image.height)
+
+    def composite(self,frame,below,above):
+        """
+        Return a hidden layer on the scratch image with the frame flattened between
+        its merged background and foreground, with the size of the image.
+        """
+        sources = [self.merged(below),frame.layer,self.merged(above)]
+        return self._scratch.merge(self.image,[l for l in sources if l != None],True)
+
+    def _layer_from_pixels(self,width,height,pixels,layer_type):
+        """
+        Return a hidden layer on the scratch image with the pixels read before.
+        """
+        scratch = self._scratch_image()
+        layer = gimp.Layer(scratch,"cached",width,height,layer_type,100,NORMAL_MODE)
+        scratch.add_layer(layer,0)
+        layer.get_pixel_rgn(0,0,width,height,True,False)[0:width,0:height] = pixels
+        layer.flush()
+        layer.visible = False
+        return layer
+
+    @staticmethod
+    def pack(sizes,columns=0,max_size=SHEET_DEFAULT_MAX_SIZE,padding=SHEET_PADDING):
+        """
+        Place the sprite sizes on the sheet, on a grid of equal cells when columns
+        is given, otherwise on shelfs from the tallest sprite that fill the max size
+        width. Return the positions in the sizes order and the sheet size.
+        """
+        positions = [None] * len(sizes)
+        if not sizes:
+            return positions, (1,1)
+
+        if columns > 0:
+            cell_w = max(w for w, h in sizes) + padding
+            cell_h = max(h for w, h in sizes) + padding
+            columns = min(columns,len(sizes))
+            rows = (len(sizes) + columns - 1) // columns
+            for i in range(len(sizes)):
+                positions[i] = ((i % columns) * cell_w,(i // columns) * cell_h)
+            return positions, (columns * cell_w - padding,rows * cell_h - padding)
+
+        order = sorted(range(len(sizes)),key=lambda i: (-sizes[i][1],-sizes[i][0]))
+        x = y = shelf_h = 0
+        width = 0
+        for i in order:
+            w, h = sizes[i]
+            if x > 0 and x + w > max_size:
+                # open a new shelf below the last one.
+                y += shelf_h + padding
+                x = shelf_h = 0
+            positions[i] = (x,y)
+            width = max(width,x + w)
+            shelf_h = max(shelf_h,h)
+            x += w + padding
+        return positions, (width,y + shelf_h)
+
+    def spritesheet(self,columns=0,max_size=SHEET_DEFAULT_MAX_SIZE,trim=True,
+            fold=True,duration=0):
+        """
+        Return a new image with the composited frames packed as an atlas, and the
+        atlas descriptor as a dict with the rect, trim offset and duration (ms) of
+        each frame. With fold the identical frames share a single cell.
+        """
+        image = self.image
+        sprites = [] # scratch layers with a cell on the sheet.
+        signatures = {} # sprite index by size and pixels digest.
+        entries = [] # (name, sprite index, bounds) of each frame.
+        plan = self.plan()
+        frame_signatures = self.cache.signatures(plan,self.image.width,
+                self.image.height,self.base_type) if self.cache else [None] * len(plan)
+        kind = "sprite trim" if trim else "sprite"
+
+        for (frame, below, above), signature in zip(plan,frame_signatures):
+            frame_duration = self.duration(frame,duration)
+            cached = self.cache.get(kind,signature) if self.cache else None
+            if cached != None:
+                bounds, digest, pixels, layer_type = cached
+                layer = self._layer_from_pixels(bounds[2],bounds[3],pixels,layer_type)
+            else:
+                layer = self.composite(frame,below,above)
+                if trim:
+                    bounds = Utils.crop_to_content(layer)
+                else:
+                    bounds = (0,0,image.width,image.height)
+                digest = None
+                if fold or self.cache:
+                    w, h = bounds[2], bounds[3]
+                    pixels = layer.get_pixel_rgn(0,0,w,h,False,False)[0:w,0:h]
+                    digest = hashlib.sha1(pixels).hexdigest()
+                if self.cache:
+                    self.cache.put(kind,signature,(bounds,digest,pixels,layer.type),len(pixels))
+
+            index = None
+            if fold:
+                key = (bounds[2],bounds[3],digest)
+                index = signatures.get(key)
+                if index == None:
+                    signatures[key] = len(sprites)
+                else:
+                    self._scratch.remove(layer)
+
+            if index == None:
+                index = len(sprites)
+                sprites.append(layer)
+            entries.append((frame.state.name,index,bounds,frame_duration))
+
+        sizes = [(l.width,l.height) for l in sprites]
+        positions, size = self.pack(sizes,columns,max_size)
+        if max(size) > max_size:
+            gimp.message("The spritesheet is %dx%d, bigger than the max size of %d."
+                    %(size[0],size[1],max_size))
+
+        # copy each sprite to its place and flatten them once.
+        sheet = gimp.Image(size[0],size[1],image.base_type)
+        sheet.disable_undo()
+        for layer, (x,y) in zip(sprites,positions):
+            copy = pdb.gimp_layer_new_from_drawable(layer,sheet)
+            sheet.add_layer(copy,0)
+            copy.visible = True
+            copy.set_offsets(x,y)
+        if len(sheet.layers) > 1:
+            sheet.merge_visible_layers(CLIP_TO_IMAGE)
+        elif sheet.layers:
+            pdb.gimp_layer_resize_to_image_size(sheet.layers[0])
+        sheet.enable_undo()
+
+        atlas_frames = []
+        for name, index, (x,y,w,h), frame_duration in entries:
+            px, py = positions[index]
+            atlas_frames.append(OrderedDict([
+                ("filename",name),
+                ("frame",OrderedDict([("x",px),("y",py),("w",w),("h",h)])),
+                ("rotated",False),
+                ("trimmed",(w,h) != (image.width,image.height)),
+                ("spriteSourceSize",OrderedDict([("x",x),("y",y),("w",w),("h",h)])),
+                ("sourceSize",OrderedDict([("w",image.width),("h",image.height)])),
+                ("duration",int(round(frame_duration))),
+            ]))
+
+        atlas = OrderedDict([
+            ("frames",atlas_frames),
+            ("meta",OrderedDict([
+                ("app",NAME),
+                ("image",""),
+                ("format","RGBA8888"),
+                ("size",OrderedDict([("w",size[0]),("h",size[1])])),
+                ("scale","1"),
+            ])),
+        ])
+        return sheet, atlas
+
+    def pixels(self,layer,indexed=False):
+        """
+        Return the pixels of a composited layer and remove it, as RGBA or as
+        (index,alpha) with the palette when indexed.
+        """
+        scratch = self._scratch_image()
+        if not layer.has_alpha:
+            pdb.gimp_layer_add_alpha(layer)
+        w, h = layer.width, layer.height
+        source = layer
+        palette = None
+        if indexed:
+            # quantize the frame on its own image.
+            quantized = gimp.Image(w,h,RGB)
+            quantized.disable_undo()
+            source = pdb.gimp_layer_new_from_drawable(layer,quantized)
+            quantized.add_layer(source,0)
+            pdb.gimp_image_convert_indexed(quantized,NO_DITHER,MAKE_PALETTE,
+                    255,False,True,"")
+            palette = bytearray(pdb.gimp_image_get_colormap(quantized)[1])
+            source = quantized.layers[0]
+
+        pixels = source.get_pixel_rgn(0,0,w,h,False,False)[0:w,0:h]
+        if indexed:
+            pdb.gimp_image_delete(quantized)
+        pdb.gimp_image_remove_layer(scratch,layer)
+        return pixels, palette
+
+    def stream(self,writer,delay,progress=None):
+        """
+        Composite the normal frames one at a time and give them to the writer, so
+        only one frame is in memory, the frames on the cache are not composited
+        again. progress is called with (done,total) before
+        each frame and returning False cancels the export, removing what was
+        written. Return True when every frame was written.
+        """
+        plan = self.plan()
+        signatures = self.cache.signatures(plan,self.image.width,
+                self.image.height,self.base_type) if self.cache else [None] * len(plan)
+        writer.begin(self.image.width,self.image.height,len(plan))
+        try:
+            for i, (frame, below, above) in enumerate(plan):
+                if progress != None and progress(i,len(plan)) == False:
+                    writer.abort()
+                    return False
+                name = frame.state.name
+                frame_delay = self.duration(frame,delay)
+                if self.cache and writer.reuse(self.cache,signatures[i],frame_delay,name):
+                    continue
+                layer = self.composite(frame,below,above)
+                pixels, palette = self.pixels(layer,writer.indexed)
+                data = writer.write(pixels,frame_delay,palette,name)
+                if self.cache:
+                    writer.store(self.cache,signatures[i],data)
+        except Exception:
+            writer.abort()
+            raise
+        writer.finish()
+        if progress != None:
+            progress(len(plan),len(plan))
+        return True
+
+    def gif_layout(self,duration=None):
+        """
+        Return a new image with a group for each normal frame, from the first
+        frame on the bottom, holding the frame with its background and foreground.
+        The groups are named with the "(Nms)" duration of the frame, or duration.
+        """
+        image = self.image
+        new_image = gimp.Image(image.width,image.height,image.base_type)
+        new_image.disable_undo()
+
+        for frame, below, above in self.plan():
+            # create a group to put the normal and the fixed frames.
+            frame_duration = self.duration(frame,duration)
+            group = gimp.GroupLayer(new_image,Utils.with_duration(frame.state.name,frame_duration))
+            new_image.add_layer(group,0)
+
+            # copy normal layer
+            lcopy = pdb.gimp_layer_new_from_drawable(frame.layer,new_image)
+            new_image.insert_layer(lcopy,group,0)
+            lcopy.visible = True
+            lcopy.opacity = 100.0
+            # sparse frames are exported with the size of the canvas.
+            pdb.gimp_layer_resize_to_image_size(lcopy)
+
+            # copy the shared background and foreground.
+            for merged, position in ((self.merged(below),1),(self.merged(above),0)):
+                if merged != None:
+                    copy = pdb.gimp_layer_new_from_drawable(merged,new_image)
+                    new_image.insert_layer(copy,group,position)
+                    copy.visible = True
+
+        new_image.enable_undo()
+        return new_image
+
+    def destroy(self):
+        self._scratch.destroy()
+        self._merged = {}
+
+
+class FixedStack:
+    """
+    The fixed frames merged in a "below" and an "above" layer for each distinct
+    set of fixed frames around a frame. While playing a normal frame they take the
+    place of the fixed layers on the canvas, and the frame cache composites them,
+    so gimp draws two layers whatever the number of fixed frames. Out of playback
+    the fixed layers are showed themselves, so they can be edited. The merged
+    stacks are kept on a hidden image until a fixed layer is changed.
+    """
+    def __init__(self,timeline,budget=CACHE_DEFAULT_SIZE):
+        self.timeline = timeline
+        self.cache = LRUCache(int(budget * 1024 * 1024),self._discard)
+        self.layers = {} # merged layer on the image by its name.
+        self.keys = {} # key of the merged layer showed by its name.
+        self._uncached = OrderedDict() # stacks bigger than the cache by key.
+        self._scratch = Scratch(RGB,self._reset) # hidden image where the stacks are kept.
+
+    def set_budget(self,budget):
+        self.cache.set_budget(int(budget * 1024 * 1024))
+
+    def is_overlay(self,layer):
+        return any(l.ID == layer.ID for l in self.layers.values())
+
+    def remove_stale(self):
+        """
+        Remove the merged layers left on the image, as when it was saved with them.
+        """
+        Utils.remove_layers_named(self.timeline.image,[FIXED_BELOW_LAYER,FIXED_ABOVE_LAYER])
+
+    def stacks(self,index):
+        """
+        Return the layers of the fixed frames below and above the frame on index,
+        from bottom to top.
+        """
+        frames = self.timeline.frames
+        below = [f.layer for f in frames[:index] if f.fixed]
+        above = [f.layer for f in frames[index+1:] if f.fixed]
+        return below, above
+
+    def is_ready(self,layers):
+        if not layers:
+            return True
+        key = tuple(l.ID for l in layers)
+        return key in self.cache or key in self._uncached
+
+    def merged(self,layers):
+        """
+        Return a hidden layer on the scratch image with the layers merged from
+        bottom to top with the size of the canvas, or None without layers.
+        """
+        if not layers:
+            return None
+        key = tuple(l.ID for l in layers)
+        merged = self.cache.get(key)
+        if merged == None:
+            merged = self._uncached.get(key)
+        if merged != None:
+            return merged
+
+        merged = self._scratch.merge(self.timeline.image,layers)
+        size = merged.width * merged.height * 4
+        if size > self.cache.budget:
+            # a stack the cache can't hold is only kept while it's one of the
+            # last two merged, the below and above stacks of the frame showed.
+            while len(self._uncached) >= 2:
+                self._scratch.remove(self._uncached.popitem(False)[1])
+            self._uncached[key] = merged
+        else:
+            self.cache.put(key,merged,size,key)
+        return merged
+
+    def show(self,index):
+        """
+        Show the merged fixed frames right below and above the frame on index.
+        The merged layers are only copied to the image when the fixed frames
+        around the frame change, otherwise moved.
+        """
+        image = self.timeline.image
+        active = self.timeline.frames[index].layer
+        below, above = self.stacks(index)
+        pdb.gimp_image_undo_freeze(image)
+        try:
+            self._place(FIXED_ABOVE_LAYER,above,active,False)
+            self._place(FIXED_BELOW_LAYER,below,active,True)
+        finally:
+            pdb.gimp_image_undo_thaw(image)
+
+    def hide(self):
+        image = self.timeline.image
+        pdb.gimp_image_undo_freeze(image)
+        for layer in self.layers.values():
+            if pdb.gimp_item_is_valid(layer):
+                image.remove_layer(layer)
+        pdb.gimp_image_undo_thaw(image)
+        self.layers = {}
+        self.keys = {}
+
+    def invalidate(self,layer=None):
+        """
+        Discard the stacks merged with the layer, or every stack when None.
+        """
+        if layer == None:
+            self.cache.clear()
+            self.keys = {}
+        else:
+            self.cache.invalidate(layer.ID)
+            for name, key in list(self.keys.items()):
+                if layer.ID in key:
+                    del self.keys[name]
+        for key in [k for k in self._uncached if layer == None or layer.ID in k]:
+            self._scratch.remove(self._uncached.pop(key))
+
+    def destroy(self,remove_layer=True):
+        if remove_layer:
+            self.hide()
+        self.layers = {}
+        self.keys = {}
+        self.cache.clear()
+        self._uncached = OrderedDict()
+        self._scratch.destroy()
+
+    def _place(self,name,layers,anchor,below):
+        """
+        Put the merged layer of name right below or above the anchor layer, with
+        the layers merged, or remove it when there are no layers.
+        """
+        image = self.timeline.image
+        layer = self.layers.get(name)
+        if layer != None and not pdb.gimp_item_is_valid(layer):
+            layer = None
+        key = tuple(l.ID for l in layers)
+
+        if layer != None and (not layers or self.keys.get(name) != key):
+            image.remove_layer(layer)
+            layer = None
+        if not layers:
+            self.layers.pop(name,None)
+            self.keys.pop(name,None)
+            return
+
+        position = pdb.gimp_image_get_item_position(image,anchor)
+        if layer == None:
+            layer = pdb.gimp_layer_new_from_drawable(self.merged(layers),image)
+            image.add_layer(layer,position + 1 if below else position)
+            layer.name = name
+            layer.visible = True
+            self.layers[name] = layer
+            self.keys[name] = key
+            return
+
+        # the position the layer gets once taken out of the stack.
+        current = pdb.gimp_image_get_item_position(image,layer)
+        target = position + 1 if below else position - 1
+        if current != target:
+            if current < position:
+                target = position if below else position - 1
+            else:
+                target = position + 1 if below else position
+            pdb.gimp_image_reorder_item(image,layer,None,target)
+
+    def _reset(self):
+        self.cache.clear()
+        self._uncached = OrderedDict()
+
+    def _discard(self,merged):
+        self._scratch.remove(merged)
+
+
+class OnionSkin:
+    """
+    Onion skin drawn as a single overlay layer on top of the layers stack, made
+    of the neighbour frames of the active one tinted backward and forward and
+    faded by distance. The overlays are kept on a hidden image by the frames
+    they are made of, so going back to a frame with a cached overlay costs the
+    same whatever the depth. The overlay changes are kept out of the image undo
+    history: the layer is replaced on the top position and hidden instead of
+    removed until the timeline closes, so the positions of the other layers, the
+    ones the undo steps keep, don't change while the timeline is open. Its
+    content is locked, as it's only a view of the frames.
+    """
+    def __init__(self,timeline,budget=CACHE_DEFAULT_SIZE):
+        self.timeline = timeline
+        self.cache = LRUCache(int(budget * 1024 * 1024),self._discard)
+        self.layer = None # overlay layer on the image.
+        self.key = None # key of the overlay showed.
+        self._scratch = Scratch(RGB,self._reset) # hidden image where the overlays are kept.
+        self._live = {} # tinted copy, opacity and distance by (layer ID, backward).
+        self._live_settings = None
+
+    def set_budget(self,budget):
+        self.cache.set_budget(int(budget * 1024 * 1024))
+
+    def is_overlay(self,layer):
+        return self.layer != None and layer.ID == self.layer.ID
+
+    def remove_stale(self):
+        """
+        Remove the overlays left on the image, as when it was saved with them.
+        """
+        Utils.remove_layers_named(self.timeline.image,[ONION_LAYER])
+
+    def window(self,index):
+        """
+        Return the (frame, distance) of the onion frames around index, from the
+        farthest, with negative distances for the backward frames.
+        """
+        t = self.timeline
+        frames = t.frames
+        window = []
+        for d in range(t.oskin_depth,0,-1):
+            for position, distance, enabled in ((index - d,-d,t.oskin_backward),
+                    (index + d,d,t.oskin_forward)):
+                if enabled and 0 <= position < len(frames) and not frames[position].fixed:
+                    window.append((frames[position],distance))
+        return window
+
+    def opacity(self,distance):
+        t = self.timeline
+        return t.oskin_max_opacity * t.oskin_falloff ** (abs(distance) - 1)
+
+    def _settings(self):
+        t = self.timeline
+        return (t.oskin_max_opacity,t.oskin_falloff,t.oskin_tint,
+                t.oskin_backward_color,t.oskin_forward_color)
+
+    def show(self,index):
+        """
+        Show the overlay of the frame on index.
+        """
+        window = self.window(index)
+        if not window:
+            self.hide()
+            return
+
+        key = self._key(window)
+        if key == self.key and self._in_place():
+            return
+
+        overlay = self.cache.get(key)
+        composited = overlay == None
+        if composited:
+            overlay = self._composite(window)
+        self._replace(overlay)
+        if composited:
+            # stored once copied, an overlay bigger than the cache is discarded.
+            self._store(window,key,overlay)
+        self.key = key
+
+    def is_ready(self,index):
+        window = self.window(index)
+        return not window or self._key(window) in self.cache
+
+    def prepare(self,index):
+        """
+        Composite the overlay of the frame on index without showing it, unless
+        the cache can't hold it.
+        """
+        window = self.window(index)
+        image = self.timeline.image
+        if window and image.width * image.height * 4 <= self.cache.budget:
+            key = self._key(window)
+            if key not in self.cache:
+                self._store(window,key,self._composite(window))
+
+    def _key(self,window):
+        return (tuple((f.layer.ID,d) for f, d in window),self._settings())
+
+    def _store(self,window,key,overlay):
+        self.cache.put(key,overlay,overlay.width * overlay.height * 4,
+                [f.layer.ID for f, d in window])
+
+    def hide(self):
+        if self.layer != None and pdb.gimp_item_is_valid(self.layer) and self.layer.visible:
+            image = self.timeline.image
+            pdb.gimp_image_undo_freeze(image)
+            self.layer.visible = False
+            pdb.gimp_image_undo_thaw(image)
+        self.key = None
+
+    def remove(self):
+        """
+        Remove the overlay layer from the image, once the timeline closes.
+        """
+        if self.layer != None and pdb.gimp_item_is_valid(self.layer):
+            image = self.timeline.image
+            pdb.gimp_image_undo_freeze(image)
+            image.remove_layer(self.layer)
+            pdb.gimp_image_undo_thaw(image)
+        self.layer = None
+        self.key = None
+
+    def invalidate(self,layer=None):
+        """
+        Discard the overlays made with the layer, or every overlay when None.
+        """
+        if layer == None:
+            self.cache.clear()
+            self._drop_live()
+        else:
+            self.cache.invalidate(layer.ID)
+            self._drop_live(layer.ID)
+        self.key = None
+
+    def destroy(self,remove_layer=True):
+        if remove_layer:
+            self.remove()
+        self.layer = None
+        self.cache.clear()
+        self._live = {}
+        self._scratch.destroy()
+
+    def _in_place(self):
+        """
+        Return if the overlay is still showed on top of the image.
+        """
+        if self.layer == None or not pdb.gimp_item_is_valid(self.layer):
+            return False
+        return self.layer.visible and \
+                pdb.gimp_image_get_item_position(self.timeline.image,self.layer) == 0
+
+    def _replace(self,overlay):
+        image = self.timeline.image
+        active = image.active_layer
+        pdb.gimp_image_undo_freeze(image)
+        try:
+            if self.layer != None and pdb.gimp_item_is_valid(self.layer):
+                image.remove_layer(self.layer)
+            layer = pdb.gimp_layer_new_from_drawable(overlay,image)
+            image.add_layer(layer,0)
+            layer.name = ONION_LAYER
+            layer.visible = True
+            pdb.gimp_item_set_lock_content(layer,True)
+            self.layer = layer
+            # the new layer becomes the active one, the frame painted is kept.
+            if active != None:
+                image.active_layer = active
+        finally:
+            pdb.gimp_image_undo_thaw(image)
+
+    def _scratch_image(self):
+        image = self.timeline.image
+        return self._scratch.get(image.width,image.height)
+
+    def _reset(self):
+        self.cache.clear()
+        self._live = {}
+
+    def _tint(self,layer,distance):
+        """
+        Colorize the layer with the backward or forward color.
+        """
+        t = self.timeline
+        color = t.oskin_backward_color if distance < 0 else t.oskin_forward_color
+        r, g, b = [int(color[i:i + 2],16) / 255.0 for i in (1,3,5)]
+        h, l, s = colorsys.rgb_to_hls(r,g,b)
+        pdb.gimp_colorize(layer,h * 360.0,s * 100.0,0)
+
+    def _composite(self,window):
         """
-        Load configuration from a file stored in gimp user folder.
+        Return a hidden layer on the scratch image with the window frames merged
+        with their tint and opacity, with the size of the canvas. The tinted copies
+        of the last window are kept as a sliding window, so stepping to the next
+        frame only copies the frames entering it, removes the ones leaving it and
+        changes the opacity of the ones changing tier.
         """
-        directory = gimp.directory + "/fanim"
-        if not os.path.exists(directory):
-            os.mkdir(directory)
+        scratch = self._scratch_image()
+        settings = self._settings()
+        if settings != self._live_settings:
+            self._drop_live()
+            self._live_settings = settings
+
+        wanted = dict(((f.layer.ID,d < 0),(f,d)) for f, d in window)
+        for key in [k for k in self._live if k not in wanted]:
+            scratch.remove_layer(self._live.pop(key)[0])
+
+        for key, (frame, distance) in wanted.items():
+            opacity = self.opacity(distance)
+            live = self._live.get(key)
+            if live == None:
+                copy = pdb.gimp_layer_new_from_drawable(frame.layer,scratch)
+                # the nearer frames stay on top of the farther ones.
+                rank = len([1 for k, (c,o,d) in self._live.items()
+                        if k in wanted and abs(wanted[k][1]) < abs(distance)])
+                scratch.add_layer(copy,rank)
+                if self.timeline.oskin_tint:
+                    self._tint(copy,distance)
+                copy.visible = True
+                copy.mode = NORMAL_MODE
+                copy.opacity = opacity
+                self._live[key] = (copy,opacity,distance)
+            elif live[1] != opacity:
+                live[0].opacity = opacity
+                self._live[key] = (live[0],opacity,distance)
+
+        # the overlay is taken from the scratch projection, keeping the copies.
+        overlay = pdb.gimp_layer_new_from_visible(scratch,scratch,"overlay")
+        scratch.add_layer(overlay,len(scratch.layers))
+        overlay.visible = False
+        return overlay
+
+    def _drop_live(self,layer_id=None):
+        """
+        Remove the tinted copies of the sliding window, of a layer or all of them.
+        """
+        for key in [k for k in self._live if layer_id == None or k[0] == layer_id]:
+            self._scratch.remove(self._live.pop(key)[0])
 
-        filepath = directory + "/" + filename
-        if os.path.exists(filepath):
-            f = open(filepath,'r')
-            dic = json.load(f)
-            f.close()
-            return dic
+    def _discard(self,overlay):
+        self._scratch.remove(overlay)
 
-        else:
-            return None
 
-    @staticmethod
-    def save_conffile(filename,conf={}):
+class PreviewWindow(gtk.Window):
+    """
+    Window that show the cached frames while playing, instead of the gimp canvas.
+    """
+    def __init__(self,title,parent=None):
+        gtk.Window.__init__(self,gtk.WINDOW_TOPLEVEL)
+        self.set_title(title)
+        self.set_keep_above(True)
+        if parent:
+            self.set_transient_for(parent)
+        # avoid the window be destroyed, the timeline decides when to close it.
+        self.connect("delete_event",lambda *args: self.hide() or True)
+
+        self.image = gtk.Image()
+        scroll_window = gtk.ScrolledWindow()
+        scroll_window.set_policy(gtk.POLICY_AUTOMATIC,gtk.POLICY_AUTOMATIC)
+        scroll_window.add_with_viewport(self.image)
+        self.add(scroll_window)
+
+    def fit_size(self,width,height):
         """
-        Save a configuration dictionary in a json file on user folder.
+        Return the size of a width x height frame scaled down to fit the window,
+        or the size the window opens with when it's hidden.
         """
-        directory = gimp.directory + "/fanim"
-        if not os.path.exists(directory):
-            os.mkdir(directory)
+        if self.get_property("visible"):
+            w, h = self.get_size()
+        else:
+            w, h = min(width+20,1280), min(height+20,800)
+        scale = min(1.0,float(w - 20) / width,float(h - 20) / height)
+        return max(1,int(width * scale)), max(1,int(height * scale))
 
-        filepath = directory + "/" + filename
-        f = open(filepath,'w')
-        json.dump(conf,f)
-        f.close()
-        
+    def show_frame(self,pixbuf):
+        if not self.get_property("visible"):
+            self.set_default_size(min(pixbuf.get_width()+20,1280),
+                    min(pixbuf.get_height()+20,800))
+            self.show_all()
+        self.image.set_from_pixbuf(pixbuf)
 
 
 class ConfDialog(gtk.Dialog):
@@ -184,6 +2150,13 @@ class ConfDialog(gtk.Dialog):
             value = widget.get_value()
         elif isinstance(widget,gtk.CheckButton):
             value = widget.get_active()
+        elif isinstance(widget,gtk.Entry):
+            value = widget.get_text()
+        elif isinstance(widget,gtk.ComboBox):
+            value = widget.get_model()[widget.get_active()][0]
+        elif isinstance(widget,gtk.ColorButton):
+            c = widget.get_color()
+            value = "#%02x%02x%02x" %(c.red >> 8,c.green >> 8,c.blue >> 8)
         self.atual_config[var_type] = value
 
     def _setup_widgets(self):
@@ -193,17 +2166,121 @@ class ConfDialog(gtk.Dialog):
         # create the frames to contein the diferent settings.
         f_time = gtk.Frame(label="Time")
         f_oskin = gtk.Frame(label="Onion Skin")
+        f_cache = gtk.Frame(label="Cache")
+        f_sheet = gtk.Frame(label="Spritesheet")
+        f_sequence = gtk.Frame(label="PNG Sequence")
         self.set_size_request(300,-1)
         self.vbox.pack_start(f_time,True,True,h_space)
         self.vbox.pack_start(f_oskin,True,True,h_space)
+        self.vbox.pack_start(f_cache,True,True,h_space)
+        self.vbox.pack_start(f_sheet,True,True,h_space)
+        self.vbox.pack_start(f_sequence,True,True,h_space)
 
         # create the time settings.
         th = gtk.HBox()
         fps,fps_spin = Utils.spin_button("Framerate",'int',self.last_config[FRAMERATE],1,100) #conf fps
 
+        drop = gtk.CheckButton("Drop frames")
+        drop.set_active(self.last_config[DROP_FRAMES])
+        drop.set_tooltip_text("skip late frames to keep the time, instead of showing every frame")
+
         th.pack_start(fps,True,True,h_space)
+        th.pack_start(drop,True,True,h_space)
+
+        # playback on the preview window using cached frames.
+        tv = gtk.VBox()
+        tv.pack_start(th)
+        th2 = gtk.HBox()
+        preview = gtk.CheckButton("Preview")
+        preview.set_active(self.last_config[PLAY_PREVIEW])
+        preview.set_tooltip_text("play the cached frames on a preview window")
+
+        proxy_store = gtk.ListStore(str,str)
+        for name, label, scale in PROXY_SCALES:
+            proxy_store.append((name,label))
+        proxy = gtk.ComboBox(proxy_store)
+        cell = gtk.CellRendererText()
+        proxy.pack_start(cell,True)
+        proxy.add_attribute(cell,'text',1)
+        proxy.set_active([p[0] for p in PROXY_SCALES].index(self.last_config[PROXY_SCALE]))
+        proxy.set_tooltip_text("resolution of the preview frames, built in the background")
+
+        th2.pack_start(preview,True,True,h_space)
+        th2.pack_start(gtk.Label("Proxy"),False,False,h_space)
+        th2.pack_start(proxy,True,True,h_space)
+        tv.pack_start(th2)
+
+        f_time.add(tv)
+
+        # create the cache settings
+        ch = gtk.HBox()
+        cache,cache_spin = Utils.spin_button("Frames MB",'int',
+                self.last_config[CACHE_SIZE],16,CACHE_MAX_SIZE,16)
+        cache.set_tooltip_text("preview frames, onionskin overlays and merged fixed frames")
+        thumbs,thumbs_spin = Utils.spin_button("Thumbs MB",'int',
+                self.last_config[THUMB_CACHE_SIZE],4,CACHE_MAX_SIZE,4)
+        store,store_spin = Utils.spin_button("Disk MB",'int',
+                self.last_config[THUMB_STORE_SIZE],0,CACHE_MAX_SIZE,16)
+        store.set_tooltip_text("thumbnails saved on disk for all the documents")
+        export,export_spin = Utils.spin_button("Export MB",'int',
+                self.last_config[EXPORT_CACHE_SIZE],0,CACHE_MAX_SIZE,16)
+        export.set_tooltip_text("frames kept from the last export, to only export the changed ones")
+
+        ch.pack_start(cache,True,True,h_space)
+        ch.pack_start(thumbs,True,True,h_space)
+        ch2 = gtk.HBox()
+        ch2.pack_start(store,True,True,h_space)
+        ch2.pack_start(export,True,True,h_space)
+        ch3 = gtk.HBox()
+        prefetch,prefetch_spin = Utils.spin_button("Read-ahead",'int',
+                self.last_config[PREFETCH_FRAMES],0,PREFETCH_MAX_FRAMES,1)
+        prefetch.set_tooltip_text("frames prepared ahead of the playhead")
+        sparse = gtk.CheckButton("Sparse frames")
+        sparse.set_active(self.last_config[SPARSE_FRAMES])
+        sparse.set_tooltip_text("new frames take the size of their content instead of the canvas")
+        ch3.pack_start(prefetch,True,True,h_space)
+        ch3.pack_start(sparse,True,True,h_space)
+        cv = gtk.VBox()
+        cv.pack_start(ch)
+        cv.pack_start(ch2)
+        cv.pack_start(ch3)
+        f_cache.add(cv)
+
+        # create the spritesheet settings
+        sv = gtk.VBox()
+        sh1 = gtk.HBox()
+        columns,columns_spin = Utils.spin_button("Columns",'int',
+                self.last_config[SHEET_COLUMNS],0,SHEET_MAX_COLUMNS,1)
+        columns.set_tooltip_text("0 packs the frames up to the max size")
+        max_size,max_size_spin = Utils.spin_button("Max size",'int',
+                self.last_config[SHEET_MAX_SIZE],64,16384,64)
+        sh1.pack_start(columns,True,True,h_space)
+        sh1.pack_start(max_size,True,True,h_space)
+
+        sh2 = gtk.HBox()
+        trim = gtk.CheckButton("Trim")
+        trim.set_active(self.last_config[SHEET_TRIM])
+        trim.set_tooltip_text("crop the transparent borders of each frame")
+        fold = gtk.CheckButton("Fold duplicates")
+        fold.set_active(self.last_config[SHEET_FOLD])
+        fold.set_tooltip_text("identical frames share the same cell")
+        sh2.pack_start(trim,True,True,h_space)
+        sh2.pack_start(fold,True,True,h_space)
+
+        sv.pack_start(sh1)
+        sv.pack_start(sh2)
+        f_sheet.add(sv)
+
+        # create the png sequence settings
+        qh = gtk.HBox()
+        pattern = gtk.Entry()
+        pattern.set_text(self.last_config[SEQUENCE_PATTERN])
+        pattern.set_tooltip_text("{name} chosen file name, {frame} layer name, "
+                "{index} frame number, as {index:04d}")
+        qh.pack_start(gtk.Label("File names"),False,False,h_space)
+        qh.pack_start(pattern,True,True,h_space)
+        f_sequence.add(qh)
 
-        f_time.add(th)
         # create onion skin settings
         ov = gtk.VBox()
         f_oskin.add(ov)
@@ -232,15 +2309,50 @@ class ConfDialog(gtk.Dialog):
         oh2.pack_start(backward,True,True,h_space)
 
         ov.pack_start(oh2)
+        # tint and falloff of the overlay
+        oh3 = gtk.HBox()
+        tint = gtk.CheckButton("Tint")
+        tint.set_active(self.last_config[OSKIN_TINT])
+        backward_color = gtk.ColorButton(gtk.gdk.color_parse(self.last_config[OSKIN_BACKWARD_COLOR]))
+        backward_color.set_tooltip_text("color of the backward frames")
+        forward_color = gtk.ColorButton(gtk.gdk.color_parse(self.last_config[OSKIN_FORWARD_COLOR]))
+        forward_color.set_tooltip_text("color of the forward frames")
+        falloff,falloff_spin = Utils.spin_button("Falloff",'float',
+                self.last_config[OSKIN_FALLOFF],0.1,1.0,0.05)
+        falloff.set_tooltip_text("opacity kept from a frame to the next farther one")
+
+        oh3.pack_start(tint,False,False,h_space)
+        oh3.pack_start(backward_color,False,False,h_space)
+        oh3.pack_start(forward_color,False,False,h_space)
+        oh3.pack_start(falloff,True,True,h_space)
+        ov.pack_start(oh3)
         # last line
 
         # connect a callback to all
         
         fps_spin.connect("value_changed",self.update_config,FRAMERATE)
+        drop.connect("toggled",self.update_config,DROP_FRAMES)
+        preview.connect("toggled",self.update_config,PLAY_PREVIEW)
+        proxy.connect("changed",self.update_config,PROXY_SCALE)
+        cache_spin.connect("value_changed",self.update_config,CACHE_SIZE)
+        thumbs_spin.connect("value_changed",self.update_config,THUMB_CACHE_SIZE)
+        store_spin.connect("value_changed",self.update_config,THUMB_STORE_SIZE)
+        export_spin.connect("value_changed",self.update_config,EXPORT_CACHE_SIZE)
+        sparse.connect("toggled",self.update_config,SPARSE_FRAMES)
+        prefetch_spin.connect("value_changed",self.update_config,PREFETCH_FRAMES)
+        columns_spin.connect("value_changed",self.update_config,SHEET_COLUMNS)
+        max_size_spin.connect("value_changed",self.update_config,SHEET_MAX_SIZE)
+        trim.connect("toggled",self.update_config,SHEET_TRIM)
+        fold.connect("toggled",self.update_config,SHEET_FOLD)
+        pattern.connect("changed",self.update_config,SEQUENCE_PATTERN)
         depth_spin.connect("value_changed",self.update_config,OSKIN_DEPTH)
         on_play.connect("toggled",self.update_config,OSKIN_ONPLAY)
         forward.connect("toggled",self.update_config,OSKIN_FORWARD)
         backward.connect("toggled",self.update_config,OSKIN_BACKWARD)
+        tint.connect("toggled",self.update_config,OSKIN_TINT)
+        backward_color.connect("color-set",self.update_config,OSKIN_BACKWARD_COLOR)
+        forward_color.connect("color-set",self.update_config,OSKIN_FORWARD_COLOR)
+        falloff_spin.connect("value_changed",self.update_config,OSKIN_FALLOFF)
 
         # show all
         self.show_all()
@@ -256,54 +2368,358 @@ class ConfDialog(gtk.Dialog):
 
 class Player():
     """
-    This class will implement a loop to play the frames through time, after
-    play each frame, a gtk event handler is called to not freaze the UI.
+    This class will play the frames through time, each frame is scheduled with a
+    gtk timer to a deadline taken from a monotonic clock, so the render time of a
+    frame don't delay the next ones and the UI keeps running on the gtk main loop.
     """
     def __init__(self,timeline,play_button):
 
         self.timeline = timeline
         self.play_button = play_button
-        self.cnt = 0
+        self.position = None # frame being played.
+        self._highlighted = None # frame highlighted by the preview playback.
+
+        self._timer = None
+        self._deadline = 0
+
+        # playback statistics.
+        self.fps = 0.0
+        self.dropped = 0
+        self._stat_frames = 0
+        self._stat_time = 0
 
     def start(self):
-        
-        while  self.timeline.is_playing:
+        """
+        Schedule the first frame and return, the playback continues on the
+        gtk main loop until stop is called.
+        """
+        self.position = self.timeline.active
+        self.fps = 0.0
+        self.dropped = 0
+        self.timeline.prefetcher.reset_stats()
+        self.timeline.prefetcher.schedule(self.position)
+        self._stat_frames = 0
+        self._stat_time = Utils.clock()
+        self._deadline = self._stat_time
+        self._schedule()
+
+    def stop(self):
+        """
+        Cancel the next scheduled frame and remove the highlight left by the preview
+        playback.
+        """
+        if self._timer != None:
+            gobject.source_remove(self._timer)
+            self._timer = None
+        self.timeline.prefetcher.clear()
+
+        if self._highlighted != None:
+            if self._highlighted < len(self.timeline.frames):
+                self.timeline.frames[self._highlighted].highlight(False)
+            self._highlighted = None
+        self.position = None
+
+    def _schedule(self):
+        delay = max(0,self._deadline - Utils.clock())
+        self._timer = gobject.timeout_add(int(delay * 1000),self._on_tick)
+
+    def _next_position(self,position):
+        """
+        Return the next not fixed frame after position.
+        """
+        frames = self.timeline.frames
+        for i in range(len(frames)):
+            position = (position + 1) % len(frames)
+            if not frames[position].fixed:
+                break
+        return position
+
+    def _last_position(self):
+        """
+        Return the last not fixed frame, where the playback ends without replay.
+        """
+        frames = self.timeline.frames
+        for i in reversed(range(len(frames))):
+            if not frames[i].fixed:
+                return i
+        return len(frames)-1
+
+    def _duration(self,position):
+        """
+        Return the time in seconds the frame is showed, its "(Nms)" hold or the
+        framerate interval.
+        """
+        duration = self.timeline.frames[position].duration
+        if duration == None:
+            return 1.0/self.timeline.framerate
+        return duration / 1000.0
+
+    def _on_tick(self):
+        self._timer = None
+        timeline = self.timeline
+        if not timeline.is_playing:
+            return False
+
+        now = Utils.clock()
+        last = self._last_position()
+        position = self._next_position(self.position)
+
+        # when late and dropping frames the frames whose time already passed are
+        # skipped to keep the time, otherwise every frame is showed starting from now.
+        if now - self._deadline > self._duration(position):
+            if timeline.drop_frames:
+                for i in range(len(timeline.frames)):
+                    if now - self._deadline <= self._duration(position):
+                        break
+                    if not timeline.is_replay and position == last:
+                        break
+                    self._deadline += self._duration(position)
+                    position = self._next_position(position)
+                    self.dropped += 1
+                else:
+                    self._deadline = now
+            else:
+                self._deadline = now
+
+        self.position = position
+        self._show(self.position)
+        self._deadline += self._duration(position)
+        self._update_stats()
+
+        # see if is the end of the timeline when theres no replay.
+        if not timeline.is_replay and self.position == last:
+            timeline.on_toggle_play(self.play_button)
+            return False
+
+        self._schedule()
+        return False
+
+    def _show(self,position):
+        timeline = self.timeline
+        ready = timeline.prefetcher.is_ready(position)
+        start = Utils.clock()
+        if timeline.play_preview:
+            # play the composited frames from the frame cache, leaving the gimp
+            # layers untouched.
+            if self._highlighted != None:
+                timeline.frames[self._highlighted].highlight(False)
+            timeline.frames[position].highlight(True)
+            timeline.frame_bar.scroll_to(position)
+            self._highlighted = position
+            timeline.preview.show_frame(timeline.frame_cache.get(position,timeline.proxy_size()))
+        else:
+            timeline.on_goto(None,POS,index=position)
+        timeline.prefetcher.shown(position,ready,Utils.clock() - start)
+
+    def _update_stats(self):
+        """
+        Measure the framerate each half second and send it to the timeline.
+        """
+        self._stat_frames += 1
+        now = Utils.clock()
+        elapsed = now - self._stat_time
+        if elapsed >= 0.5:
+            self.fps = self._stat_frames / elapsed
+            self._stat_frames = 0
+            self._stat_time = now
+            self.timeline.update_play_stats(self.fps,self.dropped)
 
-            self.timeline.on_goto(None,NEXT)
 
-            # while has fixed frames jump to the next
-            while self.timeline.frames[self.timeline.active].fixed \
-                    and self.timeline.active < len(self.timeline.frames):
-                self.timeline.on_goto(None,NEXT)
+class Prefetcher:
+    """
+    Prepare the frames ahead of the playhead in the background of the gtk main
+    loop while the current frame is on screen: the preview frames when playing
+    on the preview window, otherwise the onionskin overlay and, while playing,
+    the merged fixed frames. The frames follow the playback (skipping the fixed frames and
+    stopping at the end without replay) or the scrubbing direction, and are
+    prepared only while the caches have room. Each showed frame is counted as
+    a hit when it was ready or as a stall when it had to be prepared on time.
+    """
+    def __init__(self,timeline,depth=PREFETCH_DEFAULT_FRAMES,slice_time=0.01):
+        self.timeline = timeline
+        self.depth = depth # frames prepared ahead.
+        self.slice_time = slice_time # seconds of work on each idle call.
+        self._queue = deque()
+        self._source = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.stalls = 0
+        self.stall_time = 0.0 # seconds spent showing the not ready frames.
+
+    def hit_rate(self):
+        total = self.hits + self.stalls
+        return float(self.hits) / total if total else 0.0
+
+    def ahead(self,position,step=1):
+        """
+        Return the positions of the next frames after position, as the player
+        goes through them when playing, or stepping by step when scrubbing.
+        """
+        t = self.timeline
+        frames = t.frames
+        playing = t.is_playing
+        last = None
+        if playing and not t.is_replay:
+            normal = [i for i in range(len(frames)) if not frames[i].fixed]
+            last = normal[-1] if normal else None
+        positions = []
+        for i in range(len(frames)):
+            if len(positions) >= self.depth or position == last:
+                break
+            position = (position + step) % len(frames)
+            if playing and frames[position].fixed:
+                continue
+            positions.append(position)
+        return positions
+
+    def is_ready(self,position):
+        t = self.timeline
+        if t.is_playing and t.play_preview:
+            return t.frame_cache.has(position,t.proxy_size())
+        if t.frames[position].fixed:
+            return True
+        if t.is_playing:
+            below, above = t.fixed_stack.stacks(position)
+            if not(t.fixed_stack.is_ready(below) and t.fixed_stack.is_ready(above)):
+                return False
+        return not self._onion_showed() or t.onion.is_ready(position)
+
+    def shown(self,position,ready,elapsed,step=1):
+        """
+        Count the frame showed on position and prepare the frames after it.
+        """
+        if ready:
+            self.hits += 1
+        else:
+            self.stalls += 1
+            self.stall_time += elapsed
+        self.schedule(position,step)
+
+    def schedule(self,position,step=1):
+        self._queue = deque(self.ahead(position,step))
+        if self._queue and self._source == None:
+            self._source = gobject.idle_add(self._process)
+
+    def clear(self):
+        self._queue.clear()
+        if self._source != None:
+            gobject.source_remove(self._source)
+            self._source = None
+
+    def _onion_showed(self):
+        t = self.timeline
+        return t.oskin and not(t.is_playing and not t.oskin_onplay)
+
+    def _prepare(self,position):
+        """
+        Prepare the frame on position, return False when the cache has no room.
+        """
+        t = self.timeline
+        if t.is_playing and t.play_preview:
+            if not t.frame_cache.cache.has_room():
+                return False
+            t.frame_cache.get(position,t.proxy_size())
+            return True
+
+        if t.frames[position].fixed:
+            return True
+        if t.is_playing:
+            if not t.fixed_stack.cache.has_room():
+                return False
+            for layers in t.fixed_stack.stacks(position):
+                t.fixed_stack.merged(layers)
+        if self._onion_showed():
+            if not t.onion.cache.has_room():
+                return False
+            t.onion.prepare(position)
+        return True
+
+    def _process(self):
+        start = Utils.clock()
+        frames = self.timeline.frames
+        while self._queue and Utils.clock() - start < self.slice_time:
+            position = self._queue.popleft()
+            if position >= len(frames) or self.is_ready(position):
+                continue
+            if not self._prepare(position):
+                self._queue.clear()
+
+        if not self._queue:
+            self._source = None
+            return False
+        return True
+
+
+class AnimFrame:
+    """
+    A Frame of the timeline, the layer properties are read through the LayerState
+    mirror. The gtk widget showing the frame only exists while the frame is
+    visible on the FrameBar.
+    """
+    def __init__(self,state):
+        self.state = state
+        self.layer = state.layer
+        self.fixed = state.fixed
+        self.duration = Utils.frame_duration(state.name) # hold in ms, None follows the framerate.
+        self.widget = None # AnimFrameWidget bound to this frame.
+        self.highlighted = False
+        self.refresh_thumb = False # fetch the thumbnail again when showed.
+
+    def highlight(self,state):
+        self.highlighted = state
+        if self.widget:
+            self.widget.highlight(state)
 
-            # see if is the end of the timeline when theres no replay.
-            if not self.timeline.is_replay and self.timeline.active == \
-                    len(self.timeline.frames)-1:
-                self.timeline.on_toggle_play(self.play_button)
+    def set_fixed(self,state):
+        self.fixed = state
+        if state:
+            Utils.add_fixed_prefix(self.state)
+        else:
+            Utils.rem_fixed_prefix(self.state)
+        self.state.flush()
 
-            # wait some time to emulate framerate choose by the user.
-            time.sleep(1.0/self.timeline.framerate)
+    def set_duration(self,duration):
+        """
+        Hold the frame for duration ms, written on the layer name, or follow the
+        framerate when None.
+        """
+        self.duration = duration
+        self.state.name = Utils.with_duration(self.state.name,duration)
+        self.state.flush()
+        if self.widget:
+            self.widget.label.set_text(self.state.name)
 
-            # call gtk event handler.
-            while gtk.events_pending():
-                gtk.main_iteration()
+    def update_layer_info(self):
+        """
+        Update the frame with the layer state and mark the thumbnail to be
+        refreshed by the frame bar.
+        """
+        self.fixed = self.state.fixed
+        self.duration = Utils.frame_duration(self.state.name)
+        self.refresh_thumb = True
 
 
-class AnimFrame(gtk.EventBox):
+class AnimFrameWidget(gtk.EventBox):
     """
-    A Frame representation for gtk.
+    A Frame representation for gtk, the FrameBar recycle these widgets binding
+    them to the frames that are scrolled into view.
     """
-    def __init__(self,layer,width=100,height=120):
+    def __init__(self,loader,width=100,height=120):
         gtk.EventBox.__init__(self)
         self.set_size_request(width,height)
         #variables
+        self.loader = loader # ThumbnailLoader shared by the frames.
+        self.thumbnails = loader.thumbnails
         self.thumbnail = None
         self.label = None
-        self.layer = layer
-        self.fixed = False
+        self.frame = None # AnimFrame showed.
+        self._thumb_frame = None # frame of the showed thumbnail.
 
         self._fix_button_images = []
         self._fix_button = None
+        self._fix_handler = None
         self._setup()
 
     def highlight(self,state):
@@ -313,38 +2729,62 @@ class AnimFrame(gtk.EventBox):
             self.set_state(gtk.STATE_NORMAL)
 
     def on_toggle_fix(self,widget):
-        self.fixed = widget.get_active()
-        if widget.get_active():
-            Utils.add_fixed_prefix(self.layer)
+        self.frame.set_fixed(widget.get_active())
+        self._update_fix_image()
+
+    def bind(self,frame):
+        """
+        Show the frame on this widget, with its cached thumbnail or a placeholder.
+        """
+        if self.frame != None and self.frame is not frame and self.frame.widget is self:
+            self.frame.widget = None
+        self.frame = frame
+        frame.widget = self
+
+        self.label.set_text(frame.state.name)
+
+        # update the button without calling the callback.
+        self._fix_button.handler_block(self._fix_handler)
+        self._fix_button.set_active(frame.fixed)
+        self._fix_button.handler_unblock(self._fix_handler)
+        self._update_fix_image()
+
+        self.highlight(frame.highlighted)
+
+        # show the cached thumbnail, or the placeholder until the loader sends it.
+        pixbuf = self.thumbnails.lookup(frame.layer)
+        if pixbuf != None:
+            self.thumbnail.set_from_pixbuf(pixbuf)
+        elif self.thumbnail.get_pixbuf() == None or frame is not self._thumb_frame:
+            self.thumbnail.set_from_pixbuf(self.loader.placeholder)
+        self._thumb_frame = frame
+
+    def unbind(self):
+        if self.frame != None and self.frame.widget is self:
+            self.frame.widget = None
+        self.frame = None
+
+    def _update_fix_image(self):
+        if self._fix_button.get_active():
             self._fix_button.set_image(self._fix_button_images[0])
-        else:
-            Utils.rem_fixed_prefix(self.layer)
+        else :
             self._fix_button.set_image(self._fix_button_images[1])
 
     def _setup(self):
         self.thumbnail = gtk.Image()
-        self.label = gtk.Label(self.layer.name)
+        self.label = gtk.Label()
         # creating the fix button, to anchor background frames.
         icon_size = gtk.ICON_SIZE_MENU
         self._fix_button = Utils.toggle_button_stock(gtk.STOCK_NO, icon_size)
         self._fix_button.set_tooltip_text("toggle fixed visibility.")
 
-        # update fixed variable
-        self.fixed = Utils.is_frame_fixed(self.layer)
         #images
         self._fix_button_images = [gtk.Image(), gtk.Image()]
         self._fix_button_images[0].set_from_stock(gtk.STOCK_YES, icon_size)
         self._fix_button_images[1].set_from_stock(gtk.STOCK_NO, icon_size)
 
         ## connect
-        self._fix_button.connect('clicked',self.on_toggle_fix)
-
-        if self.fixed:
-            self._fix_button.set_image(self._fix_button_images[0])
-            self._fix_button.set_active(True)
-        else :
-            self._fix_button.set_image(self._fix_button_images[1])
-            self._fix_button.set_active(False)
+        self._fix_handler = self._fix_button.connect('clicked',self.on_toggle_fix)
 
         frame = gtk.Frame()
         layout = gtk.VBox()
@@ -357,27 +2797,122 @@ class AnimFrame(gtk.EventBox):
         layout.pack_start(self.label)
         layout.pack_start(self.thumbnail)
         layout.pack_start(self._fix_button)
-        self._get_thumb_image()
 
-    def _get_thumb_image(self):
+    def set_thumbnail(self,pixbuf):
+        self.thumbnail.set_from_pixbuf(pixbuf)
+
+
+class FrameBar(gtk.ScrolledWindow):
+    """
+    Scrollable strip showing the frames, the widgets are only created for the
+    frames in or near the visible area and are recycled while scrolling, so
+    the cost of the strip don't grow with the number of frames.
+    """
+    def __init__(self,loader,on_click,width=100,height=120,spacing=2,margin=2):
+        gtk.ScrolledWindow.__init__(self)
+        self.set_policy(gtk.POLICY_AUTOMATIC,gtk.POLICY_NEVER)
+
+        self.loader = loader # ThumbnailLoader of the frame widgets.
+        self.thumbnails = loader.thumbnails
+        self.on_click = on_click # callback(widget,event) of the frame widgets.
+        self.frame_width = width
+        self.frame_height = height
+        self.spacing = spacing
+        self.margin = margin # frames bound outside the visible area.
+
+        self.frames = []
+        self.active = 0 # its thumbnail is loaded before the others.
+        self._bound = {} # widgets by frame index.
+        self._pool = [] # unbound widgets to be recycled.
+
+        self.layout = gtk.Layout()
+        self.add(self.layout)
+        self.get_hadjustment().connect("value_changed",self._on_scroll)
+        self.layout.connect("size_allocate",self._on_scroll)
+
+    def set_frames(self,frames):
         """
-        convert the pixel info returned by python into a gtk image to be
-        showed.
+        Change the showed frames, only the visible ones are bound to widgets.
         """
-        width = 100
-        height = 100
-        image_data = pdb.gimp_drawable_thumbnail(self.layer,width,height)
+        self.frames = frames
+        step = self.frame_width + self.spacing
+        self.layout.set_size(max(1,len(frames) * step),self.frame_height)
+        self.update()
 
-        w,h,c,data = image_data[0],image_data[1],image_data[2],image_data[4]
-
-        # create a array of unsigned 8bit data.
-        image_array = array.array('B',data)
+    def update(self):
+        """
+        Bind the widgets to the frames on the visible range and recycle the others,
+        the missing thumbnails are requested to the loader with the active frame
+        first, then the visible frames and then the ones near the visible area.
+        """
+        step = self.frame_width + self.spacing
+        adj = self.get_hadjustment()
+        visible_first = int(adj.get_value() // step)
+        visible_last = int((adj.get_value() + adj.page_size) // step)
+        first = max(0,visible_first - self.margin)
+        last = min(len(self.frames)-1,visible_last + self.margin)
+
+        # release the widgets out of the range or showing another frame.
+        for i, w in list(self._bound.items()):
+            if i < first or i > last or w.frame is not self.frames[i]:
+                del self._bound[i]
+                w.unbind()
+                w.hide()
+                self._pool.append(w)
+
+        for i in range(first,last+1):
+            frame = self.frames[i]
+            w = self._bound.get(i)
+            if w == None:
+                w = self._get_widget()
+                w.bind(frame)
+                self._bound[i] = w
+                self.layout.move(w,i * step,0)
+                w.show_all()
+            elif frame.refresh_thumb:
+                w.bind(frame)
+
+            if frame.refresh_thumb or self.thumbnails.lookup(frame.layer) == None:
+                if i == self.active:
+                    tier = 0
+                elif visible_first <= i <= visible_last:
+                    tier = 1
+                else:
+                    tier = 2
+                self.loader.request(frame,(tier,abs(i - self.active)),frame.refresh_thumb)
+                frame.refresh_thumb = False
+
+    def set_active(self,index):
+        """
+        Set the active frame, scrolling it into view.
+        """
+        self.active = index
+        self.scroll_to(index)
+        self.update()
 
-        pixbuf = gtk.gdk.pixbuf_new_from_data(image_array,gtk.gdk.COLORSPACE_RGB,c>3,8,w,h,w*c)
-        self.thumbnail.set_from_pixbuf(pixbuf)
+    def scroll_to(self,index):
+        """
+        Scroll the strip so the frame on index is visible.
+        """
+        step = self.frame_width + self.spacing
+        adj = self.get_hadjustment()
+        x = index * step
+        if x < adj.get_value():
+            adj.set_value(x)
+        elif x + step > adj.get_value() + adj.page_size:
+            adj.set_value(min(x + step - adj.page_size,adj.upper - adj.page_size))
+
+    def _get_widget(self):
+        if self._pool:
+            return self._pool.pop()
+        w = AnimFrameWidget(self.loader,self.frame_width,self.frame_height)
+        w.connect("button_press_event",self.on_click)
+        self.layout.put(w,0,0)
+        return w
+
+    def _on_scroll(self,*args):
+        self.update()
 
-    def update_layer_info(self):
-        self._get_thumb_image()
 
 class Timeline(gtk.Window):
     def __init__(self,title,image):
@@ -393,16 +2928,28 @@ class Timeline(gtk.Window):
         self.play_button_images = []
         self.widgets_to_disable = [] # widgets to disable when playing
         self.play_bar = None
+        self.play_stats = None # label with the measured framerate.
+        self.prefetch_frames = PREFETCH_DEFAULT_FRAMES
+        self.prefetcher = None # frames prepared ahead of the playhead.
+        self.hold_adjustment = None # hold of the active frame.
+        self._hold_handler = None
         
         # frames
         self.frames = [] # all frame widgets
+        self.layers_state = {} # LayerState of the frame layers by ID.
+        self._frames_index = {} # frame index by layer ID.
+        self._dirty_layers = set() # LayerState with changes to flush.
+        self._window = {} # frames showed by the active frame and onionskin.
+        self._highlighted = None # highlighted frame widget.
         self.active = None  # active frame / gimp layer
         self.before_play = None # active frame before play
 
         self.framerate = 30
+        self.drop_frames = True # skip late frames to keep the time.
 
         # new frame.
         self.new_layer_type = TRANSPARENT_FILL
+        self.sparse_frames = False # frame layers at the size of their content.
 
         # onionskin variables
         self.oskin = False
@@ -411,9 +2958,40 @@ class Timeline(gtk.Window):
         self.oskin_forward = False
         self.oskin_max_opacity = OSKIN_MAX_OPACITY
         self.oskin_onplay= True
+        self.oskin_falloff = OSKIN_DEFAULT_FALLOFF
+        self.oskin_tint = True
+        self.oskin_backward_color = OSKIN_DEFAULT_BACKWARD_COLOR
+        self.oskin_forward_color = OSKIN_DEFAULT_FORWARD_COLOR
+        self.onion = None # overlay with the onionskin frames.
+        self.fixed_stack = None # merged fixed frames around the active frame.
 
         self.player = None
 
+        # playback from the composited frames cache.
+        self.play_preview = False
+        self.proxy_scale = PROXY_DEFAULT_SCALE
+        self.cache_size = CACHE_DEFAULT_SIZE
+        self.frame_cache = None
+        self.preview = None
+
+        # frames thumbnails.
+        self.thumb_cache_size = THUMB_CACHE_DEFAULT_SIZE
+        self.thumbnails = None
+        self.loader = None
+        self.thumb_store_size = THUMB_STORE_DEFAULT_SIZE
+        self._store_stamp = None # document stamp while the image is not modified.
+
+        # frames of the last exports.
+        self.export_cache_size = EXPORT_CACHE_DEFAULT_SIZE
+        self.export_cache = None
+
+        # spritesheet layout.
+        self.sheet_columns = 0
+        self.sheet_max_size = SHEET_DEFAULT_MAX_SIZE
+        self.sheet_trim = True
+        self.sheet_fold = True
+        self.sequence_pattern = SEQUENCE_DEFAULT_PATTERN
+
         # gtk window
         self.win_pos = (20,20)
         self.win_size = (200,200)
@@ -429,20 +3007,48 @@ class Timeline(gtk.Window):
         # if is closing and still playing try to stop and send a message with info.
         if self.is_playing:
             self.is_playing = False
+            self.player.stop()
             gimp.message("Please do not close the image with FAnim playing the animation.")
         if widget != False:# for when this function is called without valid image variable.
-            # return to the normal layers order.
-            pdb.script_fu_reverse_layers(self.image,None)
             self.on_goto(None,START)
+            # put the fixed layers back in place of their merged layers.
+            for f in self.frames:
+                if f.fixed:
+                    f.state.visible = True
+            self.flush_layers()
 
         #save the settings before quit.
         Utils.save_conffile(CONF_FILENAME,self.get_settings())
 
+        # save the thumbnails, when the image is closed the last known stamp is used.
+        self.loader.clear()
+        if widget != False:
+            self._update_store_stamp()
+        if self._store_stamp != None:
+            self.thumbnails.save_store(self._store_stamp)
+        self.thumbnails.close_store()
+
+        # release the cached frames, the onionskin overlays and the preview.
+        self.prefetcher.clear()
+        self.onion.destroy(widget != False)
+        self.fixed_stack.destroy(widget != False)
+        self.frame_cache.destroy()
+        self.preview.destroy()
+
         gtk.main_quit()
 
     def start(self):
         gtk.main()
 
+    def _update_store_stamp(self):
+        """
+        The thumbnails are only saved for the document file when the image is
+        the same as the file, so the stamp is taken while the image is clean.
+        """
+        self._store_stamp = None
+        if self.thumbnails.store != None and not pdb.gimp_image_is_dirty(self.image):
+            self._store_stamp = ThumbnailStore.file_stamp(self.thumbnails.store.filename)
+
     def _get_theme_gtkrc(self,themerc):
         rcpath = ""
         with  open(themerc,'r') as trc:
@@ -463,6 +3069,27 @@ class Timeline(gtk.Window):
         #load the saved setting before start.
         self.set_settings(Utils.load_conffile(CONF_FILENAME))
 
+        # composited frames to play on the preview window.
+        frames_budget, onion_budget, fixed_budget = self._cache_budgets()
+        self.frame_cache = FrameCache(self,frames_budget)
+        self.onion = OnionSkin(self,onion_budget)
+        self.fixed_stack = FixedStack(self,fixed_budget)
+        self.prefetcher = Prefetcher(self,self.prefetch_frames)
+        self.preview = PreviewWindow("FAnim Preview",self)
+        self.thumbnails = ThumbnailCache(self.thumb_cache_size)
+        self.loader = ThumbnailLoader(self.thumbnails,on_changed=self._on_thumbnail_changed)
+        self.export_cache = ExportCache(self.export_cache_size)
+
+        # thumbnails saved from the last time the document was opened, an image
+        # already modified has the file stamp but not the file pixels.
+        if self.image.filename and self.thumb_store_size > 0:
+            self.thumbnails.open_store(ThumbnailStore(self.image.filename,
+                THUMB_SIZE,self.thumb_store_size),not pdb.gimp_image_is_dirty(self.image))
+            self._update_store_stamp()
+        # the image state the thumbnails are taken from, see _check_thumbnails.
+        self._clean_stamp = None
+        self._image_unchanged()
+
         # basic window definitions
         self.connect("destroy",self.destroy)
         self.connect("focus_in_event",self.on_window_focus)
@@ -495,58 +3122,75 @@ class Timeline(gtk.Window):
         cbar.pack_start(self._setup_generalbar(),False,False,10)
 
         # frames bar widgets
-        self.frame_bar = gtk.HBox()
-        scroll_window = gtk.ScrolledWindow()
-        scroll_window.set_policy(gtk.POLICY_AUTOMATIC,gtk.POLICY_AUTOMATIC)
-        scroll_window.add_with_viewport(self.frame_bar)
-        scroll_window.set_size_request(-1,140)
+        self.frame_bar = FrameBar(self.loader,self.on_click_goto)
+        self.frame_bar.set_size_request(-1,140)
 
         # mount the widgets together
         base.pack_start(cbar,False,False,0)
-        base.pack_start(scroll_window,True,True,0)
+        base.pack_start(self.frame_bar,True,True,0)
         self.add(base)
         
-        # invert the image so onionskin can be used propely, with backward frames be
-        # above the actual frame, sinse GIMP upper layers are firstly visible they cant
-        # be backward frames.
-        pdb.script_fu_reverse_layers(self.image,None)
-        # scan all layers
+        # scan all layers, the layers stack is kept as it is and mapped to the frames
+        # order by the timeline.
+        self.onion.remove_stale()
+        self.fixed_stack.remove_stale()
         self._scan_image_layers()
         self.active = 0
         self.on_goto(None,GIMP_ACTIVE)
+        self.build_proxies()
 
         # finalize showing all widgets
         self.show_all()
 
-    def _scan_image_layers(self):
+    def _scan_image_layers(self,modified=()):
         """
-        If exists frames this function destroys all, after that the image layers
-        is scanned and the frames are recreated.
+        Reconcile the frames with the image layers, matching them by the layer ID.
+        Only the frames of new layers are created, the ones of removed layers are
+        discarded and the others are just reordered, the layers on modified have
+        their properties read again and their thumbnails updated. The frame bar
+        only binds widgets to the frames that are visible.
         """
-        self.undo(False)
+        # the frames follow the layers stack from the bottom, see _stack_position.
+        layers = list(reversed(self._frame_layers()))
+        modified = set(l.ID for l in modified if l != None)
+
+        existing = dict((f.layer.ID,f) for f in self.frames)
+        frames = []
+        for layer in layers:
+            f = existing.pop(layer.ID,None)
+            if f == None:
+                f = self._new_frame(layer)
+            elif layer.ID in modified:
+                f.state.sync()
+                f.update_layer_info()
+            frames.append(f)
+
+        # discard the frames of the layers that no longer exist.
+        for f in existing.values():
+            self._forget_layer(f.layer)
+            if self._highlighted == f:
+                self._highlighted = None
+
+        self.frames = frames
+        self._frames_index = {}
+        self._reindex_frames()
+        self.frame_bar.set_frames(frames)
+        self.flush_layers()
+
+    def _new_frame(self,layer):
+        """
+        Create the frame of a layer not yet seen by the timeline.
+        """
+        # read the layer properties once, only what changes is written later on.
+        state = LayerState(layer,self._dirty_layers)
+        self.layers_state[layer.ID] = state
 
-        layers = self.image.layers
-
-        if self.frames:
-            for frame in self.frames:
-                self.frame_bar.remove(frame)
-                frame.destroy()
-            self.frames = []
-
-        # here we get back the layers orders just in the timeline so the user can have
-        # a right interface.
-        for layer in reversed(layers):
-            # start properties
-            layer.mode = NORMAL_MODE
-            layer.opacity = 100.0
-
-            # creating frame
-            f = AnimFrame(layer)
-            f.connect("button_press_event",self.on_click_goto)
-            self.frame_bar.pack_start(f,False,True,2)
-            self.frames.append(f)
-            f.show_all()
-        self.undo(True)
+        # start properties
+        state.mode = NORMAL_MODE
+        state.opacity = 100.0
+
+        # creating frame
+        return AnimFrame(state)
 
     def _setup_playbackbar(self):
         playback_bar = gtk.HBox()
@@ -594,9 +3238,15 @@ class Timeline(gtk.Window):
         b_tostart.set_tooltip_text("To the start frame")
         b_toend.set_tooltip_text("To the end frame")
 
+        # measured framerate and dropped frames while playing.
+        self.play_stats = gtk.Label()
+        self.play_stats.set_tooltip_text("Measured framerate / dropped frames / "
+                "frames ready ahead / frames prepared late")
+
         # packing everything in gbar
         w = [b_tostart, b_prev, b_play, b_next, b_toend, b_repeat]
         map(lambda x: playback_bar.pack_start(x,False,False,0), w)
+        playback_bar.pack_start(self.play_stats,False,False,6)
         return playback_bar
 
     def _setup_editbar(self):
@@ -608,15 +3258,21 @@ class Timeline(gtk.Window):
         b_rem = Utils.button_stock(gtk.STOCK_REMOVE,stock_size)
         b_add = Utils.button_stock(gtk.STOCK_ADD,stock_size)
         b_copy = Utils.button_stock(gtk.STOCK_COPY,stock_size)
+        b_holds = Utils.button_stock(gtk.STOCK_ZOOM_FIT,stock_size)
+        b_shrink = Utils.button_stock(gtk.STOCK_LEAVE_FULLSCREEN,stock_size)
+        hold, self.hold_adjustment = Utils.spin_button("Hold ms",'int',0,0,60000,10)
 
         # add to the disable on play list
-        w = [b_back,b_forward,b_rem,b_add,b_copy]
+        w = [b_back,b_forward,b_rem,b_add,b_copy,b_holds,b_shrink,hold]
         map(lambda x: self.widgets_to_disable.append(x),w)
 
         # connect callbacks:
         b_rem.connect("clicked",self.on_remove) # remove frame
         b_add.connect("clicked",self.on_add) # add frame
         b_copy.connect("clicked",self.on_add,True) # add frame
+        b_holds.connect("clicked",self.on_fold_holds)
+        b_shrink.connect("clicked",self.on_shrink_frames)
+        self._hold_handler = self.hold_adjustment.connect("value_changed",self.on_hold_changed)
         b_back.connect("clicked",self.on_move,PREV)
         b_forward.connect("clicked",self.on_move,NEXT)
 
@@ -624,6 +3280,9 @@ class Timeline(gtk.Window):
         b_rem.set_tooltip_text("Remove a frame/layer")
         b_add.set_tooltip_text("Add a frame/layer")
         b_copy.set_tooltip_text("Duplicate the atual selected frame")
+        b_holds.set_tooltip_text("Join the identical frames in sequence into one frame held longer")
+        b_shrink.set_tooltip_text("Crop the frames layers to their content, keeping their place")
+        hold.set_tooltip_text("Time the atual frame is showed, 0 follows the framerate")
         b_back.set_tooltip_text("Move the atual selected frame backward")
         b_forward.set_tooltip_text("Move the atual selected frame forward")
 
@@ -637,20 +3296,23 @@ class Timeline(gtk.Window):
 
         b_to_gif = Utils.button_stock(gtk.STOCK_CONVERT,stock_size)
         b_to_sprite = Utils.button_stock(gtk.STOCK_CONVERT,stock_size)
+        b_export = Utils.button_stock(gtk.STOCK_SAVE_AS,stock_size)
         b_conf = Utils.button_stock(gtk.STOCK_PREFERENCES,stock_size)
 
         # connect
         b_conf.connect("clicked",self.on_config)
         b_to_gif.connect('clicked',self.create_formated_version,'gif')
         b_to_sprite.connect('clicked',self.create_formated_version,'spritesheet')
+        b_export.connect('clicked',self.on_export_animation)
 
         # tooltips
         b_conf.set_tooltip_text("open configuration dialog")
         b_to_gif.set_tooltip_text("Create a formated Image to export as gif animation")
         b_to_sprite.set_tooltip_text("Create a formated Image to export as spritesheet")
+        b_export.set_tooltip_text("Export the animation as gif, animated png or png sequence")
 
         # disable when is playing
-        w = [b_conf, b_to_gif,b_to_sprite]
+        w = [b_conf, b_to_gif,b_to_sprite,b_export]
         map(lambda x: self.widgets_to_disable.append(x),w)
 
         # pack into config_bar
@@ -705,10 +3367,28 @@ class Timeline(gtk.Window):
     def get_settings(self):
         s = {}
         s[FRAMERATE] = self.framerate
+        s[DROP_FRAMES] = self.drop_frames
         s[OSKIN_DEPTH] = self.oskin_depth
         s[OSKIN_FORWARD] = self.oskin_forward
         s[OSKIN_BACKWARD] = self.oskin_backward
         s[OSKIN_ONPLAY] = self.oskin_onplay
+        s[OSKIN_FALLOFF] = self.oskin_falloff
+        s[OSKIN_TINT] = self.oskin_tint
+        s[OSKIN_BACKWARD_COLOR] = self.oskin_backward_color
+        s[OSKIN_FORWARD_COLOR] = self.oskin_forward_color
+        s[PLAY_PREVIEW] = self.play_preview
+        s[PROXY_SCALE] = self.proxy_scale
+        s[PREFETCH_FRAMES] = self.prefetch_frames
+        s[CACHE_SIZE] = self.cache_size
+        s[THUMB_CACHE_SIZE] = self.thumb_cache_size
+        s[THUMB_STORE_SIZE] = self.thumb_store_size
+        s[EXPORT_CACHE_SIZE] = self.export_cache_size
+        s[SPARSE_FRAMES] = self.sparse_frames
+        s[SHEET_COLUMNS] = self.sheet_columns
+        s[SHEET_MAX_SIZE] = self.sheet_max_size
+        s[SHEET_TRIM] = self.sheet_trim
+        s[SHEET_FOLD] = self.sheet_fold
+        s[SEQUENCE_PATTERN] = self.sequence_pattern
 
         s[WIN_POSX] = self.win_pos[0]
         s[WIN_POSY] = self.win_pos[1]
@@ -721,13 +3401,73 @@ class Timeline(gtk.Window):
             return
 
         self.framerate = int(conf[FRAMERATE])
+        self.drop_frames = conf.get(DROP_FRAMES,self.drop_frames)
         self.oskin_depth = int(conf[OSKIN_DEPTH])
         self.oskin_forward = conf[OSKIN_FORWARD]
         self.oskin_backward = conf[OSKIN_BACKWARD]
         self.oskin_onplay = conf[OSKIN_ONPLAY]
+        self.oskin_falloff = float(conf.get(OSKIN_FALLOFF,self.oskin_falloff))
+        self.oskin_tint = conf.get(OSKIN_TINT,self.oskin_tint)
+        self.oskin_backward_color = conf.get(OSKIN_BACKWARD_COLOR,self.oskin_backward_color)
+        self.oskin_forward_color = conf.get(OSKIN_FORWARD_COLOR,self.oskin_forward_color)
+        self.play_preview = conf.get(PLAY_PREVIEW,self.play_preview)
+        self.prefetch_frames = int(conf.get(PREFETCH_FRAMES,self.prefetch_frames))
+        if conf.get(PROXY_SCALE) in [p[0] for p in PROXY_SCALES]:
+            self.proxy_scale = conf[PROXY_SCALE]
+        self.cache_size = int(conf.get(CACHE_SIZE,self.cache_size))
+        self.thumb_cache_size = int(conf.get(THUMB_CACHE_SIZE,self.thumb_cache_size))
+        self.thumb_store_size = int(conf.get(THUMB_STORE_SIZE,self.thumb_store_size))
+        self.export_cache_size = int(conf.get(EXPORT_CACHE_SIZE,self.export_cache_size))
+        self.sparse_frames = conf.get(SPARSE_FRAMES,self.sparse_frames)
+        self.sheet_columns = int(conf.get(SHEET_COLUMNS,self.sheet_columns))
+        self.sheet_max_size = int(conf.get(SHEET_MAX_SIZE,self.sheet_max_size))
+        self.sheet_trim = conf.get(SHEET_TRIM,self.sheet_trim)
+        self.sheet_fold = conf.get(SHEET_FOLD,self.sheet_fold)
+        self.sequence_pattern = conf.get(SEQUENCE_PATTERN,self.sequence_pattern)
         self.win_size  = (conf[WIN_WIDTH],conf[WIN_HEIGHT])
         self.win_pos = (conf[WIN_POSX],conf[WIN_POSY])
 
+    def _cache_budgets(self):
+        """
+        Return the megabytes of the frames cache size for the preview frames, the
+        onionskin overlays and the merged fixed frames.
+        """
+        return [self.cache_size * share for share in CACHE_SHARES]
+
+    def proxy_size(self):
+        """
+        Return the (width, height) of the preview frames with the proxy scale, or
+        None for the canvas size.
+        """
+        scale = dict((p[0],p[2]) for p in PROXY_SCALES)[self.proxy_scale]
+        width, height = self.image.width, self.image.height
+        if scale == None:
+            size = self.preview.fit_size(width,height)
+        else:
+            size = max(1,int(width * scale)), max(1,int(height * scale))
+        if size == (width,height):
+            return None
+        return size
+
+    def build_proxies(self):
+        """
+        Build the reduced preview frames in the background when the preview
+        playback uses them.
+        """
+        if self.play_preview and self.proxy_scale != PROXY_DEFAULT_SCALE:
+            self.frame_cache.build(self.proxy_size())
+        else:
+            self.frame_cache.stop_build()
+
+    def update_play_stats(self,fps,dropped):
+        """
+        Show the framerate measured by the player, the dropped frames and how the
+        prefetcher keeps up with the playback.
+        """
+        p = self.prefetcher
+        self.play_stats.set_text("%.1f fps / %d dropped / %d%% ready / %d stalls" %
+                (fps,dropped,p.hit_rate() * 100,p.stalls))
+
     def _toggle_enable_buttons(self,state):
         if state == PLAYING:
             for w in self.widgets_to_disable:
@@ -750,14 +3490,69 @@ class Timeline(gtk.Window):
         else:
             # fixing problem that happens after delete the last layer through gimp.
             # and closing when theres no layers at all.
-            if not self.image.layers:
+            layers = self._frame_layers()
+            if not layers:
                 self.destroy(False)
             else:
-                if self.active >= len(self.image.layers):
-                    self.active = len(self.image.layers)-1
-                self._scan_image_layers()
+                if self.active >= len(layers):
+                    self.active = len(layers)-1
+                self._update_store_stamp()
+                # the names (fixed, holds), visibility and opacity changed on gimp
+                # are read again and the layers added or removed are reconciled,
+                # the active layer is always refreshed as it's the one painted.
+                modified = self.resync_layers(layers)
+                active_layer = self.image.active_layer
+                if active_layer != None and active_layer.ID in self.layers_state and \
+                        all(l.ID != active_layer.ID for l in modified):
+                    modified.append(active_layer)
+                for layer in modified:
+                    self.frame_cache.invalidate(layer)
+                    self.onion.invalidate(layer)
+                    self.fixed_stack.invalidate(layer)
+                self._scan_image_layers(modified)
+                self._check_thumbnails()
                 self.on_goto(None,GIMP_ACTIVE)
 
+    def _image_unchanged(self):
+        """
+        Return if the image can't have been painted since the last call, as it
+        was clean then and it's still clean with the same file.
+        """
+        stamp = None
+        if self.image.filename and not pdb.gimp_image_is_dirty(self.image):
+            stamp = ThumbnailStore.file_stamp(self.image.filename)
+        unchanged = stamp != None and stamp == self._clean_stamp
+        self._clean_stamp = stamp
+        return unchanged
+
+    def _check_thumbnails(self):
+        """
+        Queue the cached thumbnails to be fetched again after the others, the
+        layers painted on gimp are found by the ones that changed, see
+        _on_thumbnail_changed. The frames never showed have nothing to compare.
+        """
+        if self._image_unchanged():
+            return
+        for i, f in enumerate(self.frames):
+            if f.layer.ID in self.thumbnails.cache:
+                # after the tiers of the frame bar requests.
+                self.loader.request(f,(3,abs(i - self.active)),True)
+
+    def _on_thumbnail_changed(self,frame):
+        """
+        The layer of the frame was painted on gimp, the frames and the overlays
+        made with it are composited again.
+        """
+        layer = frame.layer
+        if layer.ID not in self._frames_index:
+            return
+        self.frame_cache.invalidate(layer)
+        self.onion.invalidate(layer)
+        self.fixed_stack.invalidate(layer)
+        if not self.is_playing:
+            self.layers_show(True)
+            gimp.displays_flush()
+
     def on_about(self,widget):
         about = gtk.AboutDialog()
 
@@ -779,76 +3574,122 @@ class Timeline(gtk.Window):
             self.on_onionskin(None)
             oskin_disabled = True
 
-        # get normal and visibly fixed frames.
-        normal_frames = filter(lambda x: x.fixed == False,self.frames)
-        fixed_frames = filter(lambda x: x.fixed == True,self.frames)
-
-        new_image = gimp.Image(self.image.width,self.image.height,self.image.base_type)
-
-
-        # reverse the normal frames.
-        normal_frames.reverse()
-
-        for fl in normal_frames:
-            # create a group to put the normal and the fixed frames.
-            group = gimp.GroupLayer(new_image,fl.layer.name)
-            
-            # copy normal layer
-            lcopy = pdb.gimp_layer_new_from_drawable(fl.layer,new_image)
-            lcopy.visible = True
-
-            new_image.add_layer(group,len(new_image.layers))
-            new_image.insert_layer(lcopy,group,0)
-
-            # get the background and foreground frames.
-            up_fixed = filter(lambda x: self.frames.index(x) > self.frames.index(fl),fixed_frames)
-            bottom_fixed = filter(lambda x: self.frames.index(x) < self.frames.index(fl),fixed_frames)
-
-            # copy and insert the fixed visibility layers/frames
-            b =0
-            for ff in fixed_frames:
-                copy = pdb.gimp_layer_new_from_drawable(ff.layer,new_image)
-                if ff in bottom_fixed:
-                    new_image.insert_layer(copy,group,len(group.layers)-b)
-                    b+= 1
-                elif ff in up_fixed:
-                    new_image.insert_layer(copy,group,0)
+        # work out the background and foreground of each frame and build the layout,
+        # the frames not changed since the last export come from the export cache.
+        exporter = Exporter(self.image,self.frames,cache=self.export_cache)
 
         if format == 'gif':
             # show the formated image to export as gif.
+            new_image = exporter.gif_layout(1000.0/self.framerate)
             gimp.Display(new_image)
 
         elif format == 'spritesheet':
-            simg = gimp.Image(len(new_image.layers) * self.image.width,self.image.height,self.image.base_type)
-
-            cnt = 0
-            def novisible (x,state):
-                # change the visibility of the gimp layers.
-                 x.visible = state
-
-            # copy each frame and position it side by side.
-            # put the layers order back to normal.
-            n_img_layers = new_image.layers
-            n_img_layers.reverse()
-
-            for l in n_img_layers:
-                cl = pdb.gimp_layer_new_from_drawable(l,simg)
-                simg.add_layer(cl,0)
-
-                cl.transform_2d(0,0,1,1,0,-cnt * new_image.width,0,1,0)
-                cnt +=1
-                # merge the group as flat image.
-                map(lambda x:novisible(x,False),simg.layers)
-                cl.visible = True
-                simg.merge_visible_layers(1)
-
-            map(lambda x:novisible(x,True),simg.layers)
+            sheet, atlas = exporter.spritesheet(self.sheet_columns,self.sheet_max_size,
+                    self.sheet_trim,self.sheet_fold,1000.0/self.framerate)
             # show the formated image to export as spritesheet.
-            gimp.Display(simg)
+            gimp.Display(sheet)
+            self.save_atlas(atlas)
+
+        exporter.destroy()
         # return onionskin if was enabled
         if oskin_disabled:
             self.on_onionskin(None)
 
+    def save_atlas(self,atlas):
+        """
+        Ask where to save the spritesheet atlas descriptor as json.
+        """
+        dialog = gtk.FileChooserDialog("Save the spritesheet atlas",self,
+                gtk.FILE_CHOOSER_ACTION_SAVE,(gtk.STOCK_CANCEL,gtk.RESPONSE_CANCEL,
+                gtk.STOCK_SAVE,gtk.RESPONSE_OK))
+        dialog.set_do_overwrite_confirmation(True)
+
+        name = "spritesheet"
+        if self.image.filename:
+            dialog.set_current_folder(os.path.dirname(self.image.filename))
+            name = os.path.splitext(os.path.basename(self.image.filename))[0]
+        dialog.set_current_name(name + ".json")
+        atlas["meta"]["image"] = name + ".png"
+
+        if dialog.run() == gtk.RESPONSE_OK:
+            with open(dialog.get_filename(),'w') as f:
+                json.dump(atlas,f,indent=2)
+        dialog.destroy()
+
+    def on_export_animation(self,widget):
+        """
+        Ask the format and file and export the animation frame by frame.
+        """
+        dialog = gtk.FileChooserDialog("Export the animation",self,
+                gtk.FILE_CHOOSER_ACTION_SAVE,(gtk.STOCK_CANCEL,gtk.RESPONSE_CANCEL,
+                gtk.STOCK_SAVE,gtk.RESPONSE_OK))
+        dialog.set_do_overwrite_confirmation(True)
+        formats = gtk.combo_box_new_text()
+        for format, label, extension in STREAM_FORMATS:
+            formats.append_text(label)
+        formats.set_active(0)
+        dialog.set_extra_widget(formats)
+
+        name = "animation"
+        if self.image.filename:
+            dialog.set_current_folder(os.path.dirname(self.image.filename))
+            name = os.path.splitext(os.path.basename(self.image.filename))[0]
+        dialog.set_current_name(name + STREAM_FORMATS[0][2])
+
+        filename = None
+        if dialog.run() == gtk.RESPONSE_OK:
+            filename = dialog.get_filename()
+            format, label, extension = STREAM_FORMATS[formats.get_active()]
+        dialog.destroy()
+        if filename == None:
+            return
+        if os.path.splitext(filename)[1].lower() != extension:
+            filename += extension
+
+        options = {}
+        if format == 'sequence':
+            options["pattern"] = self.sequence_pattern
+        self.stream_export(AnimationWriter.create(format,filename,**options))
+
+    def stream_export(self,writer):
+        """
+        Stream the frames to the writer showing the progress, the user can cancel.
+        """
+        oskin_disabled = False
+        if self.oskin:
+            self.on_onionskin(None)
+            oskin_disabled = True
+
+        progress = gtk.Dialog("Exporting",self,gtk.DIALOG_MODAL,
+                (gtk.STOCK_CANCEL,gtk.RESPONSE_CANCEL))
+        bar = gtk.ProgressBar()
+        progress.vbox.pack_start(bar,True,True,4)
+        progress.set_size_request(300,-1)
+        cancelled = []
+        progress.connect("response",lambda *args: cancelled.append(True))
+        progress.show_all()
+
+        def update(done,total):
+            bar.set_fraction(float(done) / max(total,1))
+            bar.set_text("%d / %d" %(done,total))
+            while gtk.events_pending():
+                gtk.main_iteration()
+            return not cancelled
+
+        exporter = Exporter(self.image,self.frames,RGB,self.export_cache)
+        try:
+            exporter.stream(writer,1000.0/self.framerate,update)
+        except (KeyError,IndexError,ValueError) as e:
+            # most likely a bad field on the file names pattern.
+            gimp.message("Could not export the animation: %s" %e)
+        except (IOError,OSError,struct.error) as e:
+            gimp.message("Could not write the animation: %s" %e)
+        finally:
+            exporter.destroy()
+            progress.destroy()
+            if oskin_disabled:
+                self.on_onionskin(None)
+
     def on_toggle_play(self,widget):
         """
         This method change the animation play state,
@@ -876,10 +3717,14 @@ class Timeline(gtk.Window):
             # block every other button than pause.
             self._toggle_enable_buttons(PLAYING)
 
-            # start the loop to play the frames.
+            # schedule the frames on the gtk main loop, with the proxies built for
+            # the current preview window size.
+            self.update_play_stats(0,0)
+            self.build_proxies()
             self.player.start()
 
         else :
+            self.player.stop()
             # restore last frame before play.
             if self.before_play != None:
                 self.on_goto(None,POS,index=self.before_play)
@@ -911,6 +3756,16 @@ class Timeline(gtk.Window):
 
         if result == gtk.RESPONSE_APPLY:
             self.set_settings(config)
+            frames_budget, onion_budget, fixed_budget = self._cache_budgets()
+            self.frame_cache.set_budget(frames_budget)
+            self.onion.set_budget(onion_budget)
+            self.fixed_stack.set_budget(fixed_budget)
+            self.thumbnails.set_budget(self.thumb_cache_size)
+            if self.thumbnails.store != None:
+                self.thumbnails.store.budget = self.thumb_store_size * 1024 * 1024
+            self.export_cache.set_budget(self.export_cache_size)
+            self.prefetcher.depth = self.prefetch_frames
+            self.build_proxies()
         dialog.destroy()
 
     def on_move(self,widget,direction):
@@ -928,14 +3783,22 @@ class Timeline(gtk.Window):
             index = self.active-1
             if self.active-1 < 0:
                 return
-        # move layer.
-        if direction == NEXT:
+        # move layer, the later frames are higher on the layers stack, the overlays
+        # are showed again by on_goto.
+        self.onion.hide()
+        self.fixed_stack.hide()
+        if index > self.active:
             self.image.raise_layer(self.frames[self.active].layer)
-        elif direction == PREV:
+        else:
             self.image.lower_layer(self.frames[self.active].layer)
 
-        # update Timeline
-        self._scan_image_layers()
+        # update Timeline, swapping the two frames.
+        frames = self.frames
+        frames[index], frames[self.active] = frames[self.active], frames[index]
+        self._frames_index[frames[index].layer.ID] = index
+        self._frames_index[frames[self.active].layer.ID] = self.active
+        self.frame_bar.set_frames(frames)
+
         self.active = index
         self.on_goto(None,NOWHERE)
 
@@ -951,17 +3814,20 @@ class Timeline(gtk.Window):
             self.on_goto(None,PREV,True)
             index = self.active + 1
 
+        self._forget_layer(self.frames[index].layer)
+        if self._highlighted == self.frames[index]:
+            self._highlighted = None
         self.image.remove_layer(self.frames[index].layer)
-        self.frame_bar.remove (self.frames[index])
-        self.frames[index].destroy()
-        self.frames.remove(self.frames[index])
+        self.frames.pop(index)
+        self._reindex_frames(index)
+        self.frame_bar.set_frames(self.frames)
 
         if len(self.frames) == 0:
             self._toggle_enable_buttons(NO_FRAMES)
+            # check if theres layers left.
+            self.on_window_focus(None,None);
         else :
             self.on_goto(None,None,True)
-        # check if theres layers left.
-        self.on_window_focus(None,None);
 
     def on_add(self,widget,copy=False):
         """
@@ -970,36 +3836,127 @@ class Timeline(gtk.Window):
         """
         # starting gimp undo group
         self.image.undo_group_start()
+        try:
+            name = "Frame " + str(len(self.frames))
+            # create the layer to add
+            l = None
+            area = None
+            if not copy:
+                if self.sparse_frames and self.frames:
+                    # a sparse frame takes the area of the atual frame instead of the canvas.
+                    source = self.frames[self.active].layer
+                    area = source.offsets
+                    l = gimp.Layer(self.image,name,source.width,source.height,RGBA_IMAGE,100,NORMAL_MODE)
+                else:
+                    l = gimp.Layer(self.image,name, self.image.width,self.image.height,RGBA_IMAGE,100,NORMAL_MODE)
+
+            else: # copy current layer to add
+                l = self.frames[self.active].layer.copy()
+                l.name = name
+
+            # adding layer
+            index = min(self.active+1,len(self.frames))
+            self.image.add_layer(l,self._stack_position(index))
+            if area != None:
+                l.set_offsets(*area)
+            if self.new_layer_type == TRANSPARENT_FILL and not copy:
+                pdb.gimp_edit_clear(l)
+            if self.sparse_frames and copy:
+                Utils.crop_to_content(l)
+
+            # insert the frame after the active one.
+            self.frames.insert(index,self._new_frame(l))
+            self._reindex_frames(index)
+            self.frame_bar.set_frames(self.frames)
+            self.flush_layers()
+            self.on_goto(None,NEXT,True)
+
+            if len(self.frames) == 1 :
+                self._toggle_enable_buttons(NO_FRAMES)
+        finally:
+            # ending gimp undo group
+            self.image.undo_group_end()
+
+    def on_shrink_frames(self,widget):
+        """
+        Crop every frame layer to its content, the composited frames and the
+        exports stay the same but the layers take much less memory.
+        """
+        self.image.undo_group_start()
+        try:
+            for f in self.frames:
+                Utils.crop_to_content(f.layer)
+                f.refresh_thumb = True
+        finally:
+            self.image.undo_group_end()
+        self.frame_bar.update()
+        self.on_goto(None,POS,index=self.active)
+
+    def _update_hold(self):
+        """
+        Show the hold of the active frame without changing it.
+        """
+        duration = self.frames[self.active].duration
+        self.hold_adjustment.handler_block(self._hold_handler)
+        self.hold_adjustment.set_value(duration or 0)
+        self.hold_adjustment.handler_unblock(self._hold_handler)
 
-        name = "Frame " + str(len(self.frames))
-        # create the layer to add
-        l = None
-        if not copy:
-            l = gimp.Layer(self.image,name, self.image.width,self.image.height,RGBA_IMAGE,100,NORMAL_MODE)
-
-        else: # copy current layer to add
-            l = self.frames[self.active].layer.copy()
-            l.name = name
-
-        # adding layer
-        self.image.add_layer(l,len(self.image.layers)-self.active-1)
-        if self.new_layer_type == TRANSPARENT_FILL and not copy:
-            pdb.gimp_edit_clear(l)
+    def on_hold_changed(self,adjustment):
+        """
+        Set the hold of the active frame, 0 follows the framerate.
+        """
+        if not self.frames:
+            return
+        duration = int(adjustment.get_value())
+        self.frames[self.active].set_duration(duration or None)
 
-        self._scan_image_layers()
-        self.on_goto(None,NEXT,True)
+    def on_fold_holds(self,widget):
+        """
+        Find the identical frames in sequence by their pixels and keep only the
+        first one, holding it for the duration of all of them with "(Nms)".
+        """
+        default = 1000.0/self.framerate
+        holds = OrderedDict() # kept frame: duration
+        removed = []
+        kept = kept_digest = None
+        for f in self.frames:
+            if f.fixed:
+                # the fixed frames change the frames around them.
+                kept = None
+                continue
+            digest = ExportCache.layer_digest(f.layer)
+            duration = default if f.duration == None else f.duration
+            if kept != None and digest == kept_digest:
+                holds[kept] += duration
+                removed.append(f)
+            else:
+                kept, kept_digest = f, digest
+                holds[f] = duration
 
-        if len(self.frames) == 1 :
-            self._toggle_enable_buttons(NO_FRAMES)
+        if not removed:
+            return
 
-        # ending gimp undo group
+        self.image.undo_group_start()
+        for f in removed:
+            self.image.remove_layer(f.layer)
+        modified = []
+        for f, duration in holds.items():
+            if duration != (default if f.duration == None else f.duration):
+                f.set_duration(duration)
+                modified.append(f.layer)
         self.image.undo_group_end()
 
+        self.frame_cache.invalidate()
+        self.onion.invalidate()
+        self.fixed_stack.invalidate()
+        self._scan_image_layers(modified)
+        self.on_goto(None,POS,index=min(self.active,len(self.frames)-1))
+
     def on_click_goto(self,widget,event):
         """
         handlers a click on frame widgets.
         """
-        i = self.frames.index(widget)
+        i = self.frame_index(widget.frame.layer)
         self.on_goto(None,POS,index=i)
 
     def on_goto(self,widget,to,update=False,index=0):
@@ -1008,10 +3965,11 @@ class Timeline(gtk.Window):
         (to) indicate, the macros are (START, END, NEXT, PREV,POS,GIMP_ACTIVE)
         - called once per frame when is_playing is enabled.
         """
-        self.layers_show(False)
-
         if update:
             self.frames[self.active].update_layer_info()
+            self.frame_cache.invalidate(self.frames[self.active].layer)
+            self.onion.invalidate(self.frames[self.active].layer)
+            self.fixed_stack.invalidate(self.frames[self.active].layer)
 
         if to == START:
             self.active = 0
@@ -1034,66 +3992,163 @@ class Timeline(gtk.Window):
             self.active = index
 
         elif to == GIMP_ACTIVE:
-            if self.image.active_layer in self.image.layers:
-                self.active = self.image.layers.index(self.image.active_layer)
-                self.active = len(self.image.layers)-1-self.active
-            else :self.active = 0
+            active_layer = self.image.active_layer
+            i = None
+            if active_layer != None:
+                i = self.frame_index(active_layer)
+            if i != None:
+                self.active = i
+            # the overlays picked on the layers dialog keep the active frame.
+            elif active_layer == None or not(self.onion.is_overlay(active_layer)
+                    or self.fixed_stack.is_overlay(active_layer)):
+                self.active = 0
+
+        # the player counts and prefetches its own frames.
+        scrubbing = to in (NEXT,PREV) and not self.is_playing
+        if scrubbing:
+            ready = self.prefetcher.is_ready(self.active)
+            start = Utils.clock()
 
         self.layers_show(True)
+        self.frame_bar.set_active(self.active)
+        self._update_hold()
         self.image.active_layer = self.frames[self.active].layer
 
         gimp.displays_flush() # update the gimp GUI
+        if scrubbing:
+            self.prefetcher.shown(self.active,ready,Utils.clock() - start,
+                    -1 if to == PREV else 1)
 
 
     def layers_show(self,state):
         """
-        Util function to hide the old frames and show the next.
+        Util function to show the active frame with its onionskin, or hide them
+        when state is False. Only the layers whose visibility or opacity change
+        from the last call are written to gimp.
         """
-        self.undo(False)
+        window = {}
+        if state:
+            window = self._frames_window()
+
+        # while playing a normal frame the fixed frames are drawn by their merged
+        # layers, otherwise the fixed layers stay on the canvas to be edited.
+        active = self.frames[self.active] if self.frames else None
+        merge_fixed = state and self.is_playing and active != None and not active.fixed
+
+        # frames leaving the window are hidden again, except the fixed ones.
+        for layer_id, frame in self._window.items():
+            if layer_id not in window:
+                window[layer_id] = (frame,frame.fixed and not merge_fixed,100.0)
+
+        for layer_id, (frame,visible,opacity) in window.items():
+            frame.state.opacity = opacity
+            frame.state.visible = visible
+
+        for f in self.frames:
+            if f.fixed and f.layer.ID not in window:
+                f.state.visible = not merge_fixed
+        self.flush_layers()
+
+        # the onionskin frames are drawn by the overlay on top of the stack.
+        if state and active != None and self.oskin and not active.fixed \
+                and not(self.is_playing and not self.oskin_onplay):
+            self.onion.show(self.active)
+        else:
+            self.onion.hide()
 
-        opacity = 0
+        if merge_fixed:
+            self.fixed_stack.show(self.active)
+        else:
+            self.fixed_stack.hide()
 
-        self.frames[self.active].layer.opacity = 100.0
+        # keep only the frames showed by the timeline on the window.
+        self._window = dict((k,v[0]) for k,v in window.items() if v[1] and not v[0].fixed)
 
-        if not state:
-            opacity = 100.0
-        else :
-            opacity = self.oskin_max_opacity
+        # highlight or not the frame
+        if self._highlighted != None:
+            self._highlighted.highlight(False)
+            self._highlighted = None
+        if state:
+            self._highlighted = self.frames[self.active]
+            self._highlighted.highlight(True)
 
-        self.frames[self.active].layer.visible = state # show or hide the frame
-        self.frames[self.active].highlight(state) # highlight or not the frame
+    def _frames_window(self):
+        """
+        Return the state (frame, visible, opacity) by layer ID of the frames the
+        timeline shows on the canvas, the active frame, the onionskin frames are
+        composited on the overlay by OnionSkin.
+        """
+        active = self.frames[self.active]
+        return {active.layer.ID: (active,True,100.0)}
 
-        is_fixed = self.frames[self.active].fixed # if actual frame is fixed
+    def _stack_position(self,index):
+        """
+        Return the position on the gimp layers stack (0 is the top) where a layer
+        is added to become the frame on index. The image is never reordered by the
+        timeline, the first frame is the bottom layer as on gimp animations, so the
+        frames before the active one, the background fixed frames, are stacked
+        below it and the later ones above it. The new layer goes right above the
+        frame before it, or to the bottom as the first frame.
+        """
+        if index == 0 or not self.frames:
+            return len(self.image.layers)
+        return pdb.gimp_image_get_item_position(self.image,self.frames[index-1].layer)
 
-        if (self.oskin and not is_fixed) and not(self.is_playing and not self.oskin_onplay):
-            # calculating the onionskin backward and forward
-            for i in range(1,self.oskin_depth +1):
-                # calculating opacity level
-                o = opacity
-                if i > 1 and state: o = opacity / i-1 * 2
+    def _frame_layers(self):
+        """
+        Return the image layers that are frames, without the onionskin overlay and
+        the merged fixed frames.
+        """
+        return [l for l in self.image.layers if not self.onion.is_overlay(l)
+                and not self.fixed_stack.is_overlay(l)]
 
-                pos = self.active - i
-                if self.oskin_backward and pos >= 0:
-                    is_fixed = self.frames[pos].fixed
-                    if not is_fixed: # discard fixed frames
-                        # calculate onionskin depth opacity decay.
-                        self.frames[pos].layer.visible = state
-                        self.frames[pos].layer.opacity = o
+    def frame_index(self,layer):
+        """
+        Return the index of the frame of the layer, or None when the layer isn't
+        a frame.
+        """
+        return self._frames_index.get(layer.ID)
 
-                pos = self.active +i
-                if self.oskin_forward and pos <= len(self.frames)-1:
-                    is_fixed = self.frames[pos].fixed
-                    #self.frames[self.active].layer.opacity = min(100.0, 1.5*opacity)
+    def _reindex_frames(self,start=0):
+        """
+        Update the frame indexes by layer ID from start to the end of the frames.
+        """
+        for i in range(start,len(self.frames)):
+            self._frames_index[self.frames[i].layer.ID] = i
 
-                    if not is_fixed:# discard fixed frames
-                        # calculate onionskin depth opacity decay.
-                        self.frames[pos].layer.visible = state
-                        self.frames[pos].layer.opacity = o
+    def flush_layers(self):
+        """
+        Write to gimp every layer property changed since the last flush, called
+        once for each user action or playback frame.
+        """
+        if not self._dirty_layers:
+            return
+        self.undo(False)
+        for state in self._dirty_layers:
+            state.flush()
+        self._dirty_layers.clear()
+        self.undo(True)
 
-        if self.frames[self.active].fixed and state == False:
-            self.frames[self.active].layer.visible = True
+    def resync_layers(self,layers=None):
+        """
+        Read the layer properties from gimp again, for when they are changed
+        outside FAnim, and return the layers whose properties changed. When
+        layers is given only those are read, the others may no longer exist.
+        """
+        ids = None if layers == None else set(l.ID for l in layers)
+        changed = [state.layer for layer_id, state in self.layers_state.items()
+                if (ids == None or layer_id in ids) and state.sync()]
+        self._dirty_layers.clear()
+        return changed
 
-        self.undo(True)
+    def _forget_layer(self,layer):
+        """
+        Stop tracking the state of a layer that is going to be removed.
+        """
+        state = self.layers_state.pop(layer.ID,None)
+        self._dirty_layers.discard(state)
+        self._window.pop(layer.ID,None)
+        self._frames_index.pop(layer.ID,None)
 
 
 def timeline_main(image,drawable):
@@ -1105,6 +4160,127 @@ def timeline_main(image,drawable):
     win = Timeline(WINDOW_TITLE,image)
     win.start()
 
+def batch_output(filename,format,output_dir=""):
+    """
+    Return the file the batch export writes for a xcf file, the spritesheet
+    atlas is saved beside it with the json extension.
+    """
+    directory = output_dir or os.path.dirname(filename)
+    name = os.path.splitext(os.path.basename(filename))[0]
+    extension = ".gif" if format == 'gif' else ".png"
+    return os.path.join(directory,name + extension)
+
+def batch_export_file(filename,format,output_dir,conf):
+    """
+    Export the formated version of a single xcf file.
+    """
+    image = pdb.gimp_file_load(filename,filename)
+    output = batch_output(filename,format,output_dir)
+    delay = 1000.0 / int(conf.get(FRAMERATE,30))
+    if format in ('gif','apng'):
+        exporter = Exporter.from_image(image,RGB)
+    else:
+        exporter = Exporter.from_image(image)
+    try:
+        if format in ('gif','apng'):
+            gimp.progress_init("Exporting " + os.path.basename(filename))
+            def progress(done,total):
+                gimp.progress_update(float(done) / max(total,1))
+            exporter.stream(AnimationWriter.create(format,output),delay,progress)
+        else:
+            new_image, atlas = exporter.spritesheet(
+                    int(conf.get(SHEET_COLUMNS,0)),
+                    int(conf.get(SHEET_MAX_SIZE,SHEET_DEFAULT_MAX_SIZE)),
+                    conf.get(SHEET_TRIM,True),conf.get(SHEET_FOLD,True),delay)
+            pdb.file_png_save_defaults(new_image,new_image.layers[0],output,output)
+            atlas["meta"]["image"] = os.path.basename(output)
+            with open(os.path.splitext(output)[0] + ".json",'w') as f:
+                json.dump(atlas,f,indent=2)
+            pdb.gimp_image_delete(new_image)
+    finally:
+        exporter.destroy()
+        pdb.gimp_image_delete(image)
+
+def batch_export(files,format,output_dir):
+    """
+    gimp call to export many files without the timeline, files is a list of file
+    names or glob patterns separated by the path separator. Used by the command
+    line batch, but can be called by any other script.
+    """
+    if isinstance(format,int):
+        format = BATCH_FORMATS[format]
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    conf = Utils.load_conffile(CONF_FILENAME) or {}
+
+    for pattern in files.split(os.pathsep):
+        pattern = pattern.strip()
+        filenames = [pattern] if os.path.isfile(pattern) else sorted(glob.glob(pattern))
+        for filename in filenames:
+            try:
+                batch_export_file(filename,format,output_dir,conf)
+            except Exception as e:
+                # keep exporting the other files.
+                gimp.message("FAnim could not export %s: %s" %(filename,e))
+
+def batch_command(argv):
+    """
+    Command line batch, exports the xcf files across gimp instances running on
+    the background and return the number of files that failed.
+    """
+    parser = argparse.ArgumentParser(prog="fanim.py --batch",description=BATCH_DESCRIPTION)
+    parser.add_argument("files",nargs="+",help="xcf files or glob patterns")
+    parser.add_argument("-f","--format",choices=BATCH_FORMATS,default="gif")
+    parser.add_argument("-o","--output",default="",help="output folder, default beside each file")
+    parser.add_argument("-j","--jobs",type=int,default=0,
+            help="number of gimp instances, default the number of cpus")
+    parser.add_argument("--gimp",default="gimp-console",help="gimp executable")
+    args = parser.parse_args(argv)
+
+    files = []
+    for pattern in args.files:
+        files.extend(sorted(glob.glob(pattern)) or [pattern])
+    if not files:
+        return 0
+    output = os.path.abspath(args.output) if args.output else ""
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+
+    # chunks small enough to balance the instances but paying gimp startup once each.
+    size = max(1,min(BATCH_CHUNK,(len(files) + jobs - 1) // jobs))
+    chunks = [files[i:i + size] for i in range(0,len(files),size)]
+
+    def quote(text):
+        return '"' + text.replace('\\','\\\\').replace('"','\\"') + '"'
+
+    def mtime(filename):
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return None
+
+    def run(chunk):
+        paths = os.pathsep.join(os.path.abspath(f) for f in chunk)
+        command = "(%s RUN-NONINTERACTIVE %s %d %s)" %(BATCH_PROCEDURE,quote(paths),
+                BATCH_FORMATS.index(args.format),quote(output))
+        outputs = [batch_output(os.path.abspath(f),args.format,output) for f in chunk]
+        before = [mtime(o) for o in outputs]
+        subprocess.call([args.gimp,"-i","-d","-f","-b",command,"-b","(gimp-quit 0)"])
+        # an exported file written by this run is the only reliable sign that the
+        # file was done, the outputs left by older runs don't count.
+        failed = [f for f, o, t in zip(chunk,outputs,before)
+                if mtime(o) == None or mtime(o) == t]
+        for f in failed:
+            sys.stderr.write("failed: %s\n" %f)
+        return len(failed)
+
+    pool = ThreadPool(min(jobs,len(chunks)))
+    try:
+        failed = sum(pool.map(run,chunks))
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
 # register the script on GIMP
 register(
         "fanim_timeline",
@@ -1116,4 +4292,22 @@ register(
         GIMP_LOCATION,
         "*",
         [],[],timeline_main)
+
+register(
+        "fanim_batch_export",
+        BATCH_DESCRIPTION,
+        BATCH_DESCRIPTION,
+        AUTHORS[0],
+        AUTHORS[0],
+        YEAR,
+        "FAnim Batch Export...",
+        "",
+        [
+            (PF_STRING,"files","Files or glob patterns, separated by " + os.pathsep,""),
+            (PF_OPTION,"format","Format",0,BATCH_FORMATS),
+            (PF_DIRNAME,"output_dir","Output folder, empty to save beside each file",""),
+        ],[],batch_export,menu="<Image>/FAnim")
+
+if __name__ == '__main__' and sys.argv[1:2] == ["--batch"]:
+    sys.exit(batch_command(sys.argv[2:]))
 main()